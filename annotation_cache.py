@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from cachetools import LRUCache
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+DEFAULT_ANNOTATION_CACHE_DIR = os.environ.get("SINTMINT_ANNOTATION_CACHE_DIR",
+                                              "annotation_cache")
+
+# the in-memory cache sits in front of the disk cache and holds the most
+# recently used serialized responses
+DEFAULT_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_CACHE_BYTES = 512 * 1024 * 1024
+
+# when the disk cache goes over its budget, trim it down to this fraction of
+# the budget so that we aren't evicting on every single write
+DISK_TRIM_RATIO = 0.9
+
+CACHE_FILE_SUFFIX = ".pb"
+
+# caches serialized AnnotateTextResponses keyed by the content of the document
+# that was sent off to google, so that the same page showing up for different
+# entities doesn't cost another request
+class AnnotationCache():
+
+    file_suffix = CACHE_FILE_SUFFIX
+
+    def __init__(self,
+                 directory=DEFAULT_ANNOTATION_CACHE_DIR,
+                 memory_bytes=DEFAULT_MEMORY_CACHE_BYTES,
+                 disk_bytes=DEFAULT_DISK_CACHE_BYTES):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.memory = LRUCache(maxsize=memory_bytes, getsizeof=len)
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        # the directory only gets added up the first time we write to it, so
+        # that a big cache doesn't slow down starting up
+        self.disk_size = None
+
+    def get_key(self, content, document_type, features):
+        digest = hashlib.sha256()
+        digest.update(document_type.encode())
+        digest.update(b"\0")
+        digest.update(json.dumps(features, sort_keys=True).encode())
+        digest.update(b"\0")
+        digest.update(content.encode(errors="replace"))
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.file_suffix)
+
+    def disk_entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.file_suffix):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # another process evicted it from under us
+                continue
+
+            entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+        if data is not None:
+            return data
+
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as cache_file:
+                data = cache_file.read()
+
+            # bump the mtime, since that's what we evict by
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            self.store_in_memory(key, data)
+
+        return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.store_in_memory(key, data)
+
+        # write to a temporary file first so that other readers never see a
+        # partially written response
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, "wb") as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, self.get_path(key))
+
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for path, size, mtime in \
+                                     self.disk_entries())
+            else:
+                self.disk_size += len(data)
+            if self.disk_size > self.disk_bytes:
+                self.trim_disk()
+
+    def store_in_memory(self, key, data):
+        # cachetools refuses values bigger than the whole cache
+        if len(data) <= self.memory.maxsize:
+            self.memory[key] = data
+
+    def trim_disk(self):
+        # other processes may be writing to the same directory, so go off of
+        # what is actually on disk rather than our own running total
+        entries = sorted(self.disk_entries(), key=lambda entry: entry[2])
+        self.disk_size = sum(size for path, size, mtime in entries)
+
+        target_size = self.disk_bytes * DISK_TRIM_RATIO
+        for path, size, mtime in entries:
+            if self.disk_size <= target_size:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.disk_size -= size
@@ -1,10 +1,30 @@
 # Author: Antony Toron
 
-from flask import Flask, render_template, request
+import time
+
+# how long it takes to get from here to serving requests, which is most of
+# what a dyno restart costs
+IMPORT_START = time.perf_counter()
+
+from flask import Flask, Response, render_template, request, jsonify, \
+    url_for, abort
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from sintmint import *
+from store import SentimentStore
+from annotation_cache import AnnotationCache
+from page_cache import PageCache
+from jobs import JobQueue, JOB_DONE, DEFAULT_JOB_WORKERS
+from refresh import RefreshScheduler, DEFAULT_REFRESH_BUDGET
+from metrics import Trace
+import json
+import logging
+import os
+import threading
+
+logging.basicConfig(level=os.environ.get("SINTMINT_LOG_LEVEL", "WARNING"))
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 limiter = Limiter(
@@ -13,7 +33,57 @@ limiter = Limiter(
     default_limits=["200 per day", "50 per hour"]
 )
 
-sintmint = SintMint()
+# nothing in here connects to anything yet, so the app can be imported once
+# and then forked into workers (gunicorn --preload). the language API client
+# gets made in each worker the first time it's needed
+sintmint = SintMint(store=SentimentStore(),
+                    annotation_cache=AnnotationCache(),
+                    page_cache=PageCache(),
+                    analysis_tier=os.environ.get("SINTMINT_ANALYSIS_TIER",
+                                                 DEFAULT_ANALYSIS_TIER),
+                    pack_documents=os.environ.get(
+                        "SINTMINT_PACK_DOCUMENTS") == "1",
+                    hedged=os.environ.get("SINTMINT_HEDGED") == "1",
+                    clean_workers=int(os.environ.get(
+                        "SINTMINT_CLEAN_WORKERS",
+                        DEFAULT_CLEAN_WORKERS)))
+
+# queries take several seconds, so they run in the background and the page
+# polls for them instead of holding up a worker for the whole query. they
+# mostly wait on the shared fetch and annotate pools, so one process can have
+# a good number of them going at once
+jobs = JobQueue(sintmint.get_sentiment_score,
+                max_workers=int(os.environ.get("SINTMINT_JOB_WORKERS",
+                                               DEFAULT_JOB_WORKERS)))
+
+# re-scores the popular entities before their stored results expire, with
+# SINTMINT_REFRESH_BUDGET (0 turns it off) being the most an hour
+refresher = RefreshScheduler(
+    sintmint,
+    sintmint.store,
+    budget=int(os.environ.get("SINTMINT_REFRESH_BUDGET",
+                              DEFAULT_REFRESH_BUDGET)))
+
+sintmint.metrics.record_startup("import", time.perf_counter() - IMPORT_START)
+
+# how often a quiet event stream sends a comment, so that proxies (and the
+# router) don't give up on the connection
+EVENT_KEEPALIVE_SECONDS = 15
+
+# every open event stream holds on to one of the worker's threads (see the
+# Procfile) for as long as its query runs, so only this many at once. past
+# that, the page gets a 503 and polls the status instead, which leaves the
+# rest of the threads for everything else
+DEFAULT_MAX_EVENT_STREAMS = 4
+event_streams = threading.BoundedSemaphore(
+    int(os.environ.get("SINTMINT_MAX_EVENT_STREAMS",
+                       DEFAULT_MAX_EVENT_STREAMS)))
+
+# the refresher's thread has to be started in the worker itself, rather than
+# when the app is imported
+@app.before_request
+def start_refresher():
+    refresher.start()
 
 @app.route("/")
 def index():
@@ -23,11 +93,103 @@ def index():
 @limiter.limit("3 per day")
 def sentiment():
     target_entity = request.form["entity"]
-    print(target_entity)
+    logger.info("Sentiment requested for %s", target_entity)
+
+    # ?trace=1 records where the query's time went, and hands it back with
+    # the status
+    trace = None
+    if request.values.get("trace"):
+        trace = Trace()
+
+    job = jobs.submit(target_entity, trace)
+
+    return jsonify(
+        job_id=job.job_id,
+        status_url=url_for("sentiment_status", job_id=job.job_id),
+        events_url=url_for("sentiment_events", job_id=job.job_id),
+        result_url=url_for("sentiment_result", job_id=job.job_id)), 202
+
+# polled by the page every second or so while the query runs, so this can't
+# count against the default limits
+@app.route("/sentiment/<job_id>/status")
+@limiter.exempt
+def sentiment_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    status = {"status": job.get_status()}
+    if job.trace is not None:
+        status["trace"] = job.trace.to_json()
+
+    return jsonify(status)
+
+def format_event(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+# streams each page's score as it comes in (as server-sent events), so the
+# page can show the score so far instead of a spinner. this holds on to one
+# of the worker's threads for as long as the query runs
+@app.route("/sentiment/<job_id>/events")
+@limiter.exempt
+def sentiment_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    if not event_streams.acquire(blocking=False):
+        return Response("Too many event streams, poll the status instead",
+                        status=503,
+                        mimetype="text/plain")
+
+    result_url = url_for("sentiment_result", job_id=job.job_id)
+
+    def stream():
+        num_sent = 0
+        while True:
+            updates, done = job.wait_for_updates(num_sent,
+                                                 EVENT_KEEPALIVE_SECONDS)
+            for update in updates:
+                yield format_event("page", update)
+            num_sent += len(updates)
+
+            if done:
+                yield format_event("done",
+                                   {"status": job.get_status(),
+                                    "result_url": result_url})
+                return
+
+            if len(updates) == 0:
+                yield ": keepalive\n\n"
+
+    response = Response(stream(),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
+    # the server closes the response however the stream ends, including the
+    # browser going away before it's done
+    response.call_on_close(event_streams.release)
+    return response
+
+# scraped by prometheus, so it can't count against the default limits either
+@app.route("/metrics")
+@limiter.exempt
+def metrics():
+    return Response(sintmint.metrics.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+@app.route("/sentiment/<job_id>")
+def sentiment_result(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.get_status() != JOB_DONE:
+        abort(404)
 
-    sentiment_score, entity_category = \
-        sintmint.get_sentiment_score(target_entity)
+    sentiment_score, entity_category = job.future.result()
+    return render_sentiment(job.target_entity,
+                            sentiment_score,
+                            entity_category)
 
+def render_sentiment(target_entity, sentiment_score, entity_category):
     # generally, articles will not have extremely polarizing words about
     # people throughout, to make the score reach the [-1.0, 1.0] bounds
     # to make the range a bit more realistic, we should go from ~[-0.3, 0.3]
@@ -0,0 +1,7 @@
+# Author: Antony Toron
+
+# offline benchmarks for the whole scoring pipeline. recorded (or synthetic)
+# search pages, result pages and language API responses get replayed by a
+# local http server and a fake LanguageServiceClient, so nothing here needs
+# the network or credentials. run from the repo root with
+#   python -m bench.run
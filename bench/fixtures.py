@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# a fixture set is a directory with:
+#   manifest.json       entity -> its search page, page id -> how to serve it
+#   search/<n>.html     google search pages, with the result links rewritten
+#                       to replay:<page id> (or replay:missing)
+#   pages/<page id>     the raw result pages, exactly as they were downloaded
+#   annotations/<sha256 of the document content>.pb
+#                       serialized AnnotateTextResponse protos
+
+import hashlib
+import json
+import os
+import random
+import re
+
+MANIFEST_NAME = "manifest.json"
+SEARCH_DIRECTORY = "search"
+PAGES_DIRECTORY = "pages"
+ANNOTATIONS_DIRECTORY = "annotations"
+
+# result links in a recorded search page point here instead of the real site,
+# and get pointed at the stub server when the page is served
+REPLAY_LINK_PREFIX = "replay:"
+REPLAY_LINK_PATTERN = re.compile(r"/url\?q=" + REPLAY_LINK_PREFIX + r"(\w+)")
+# for the links in a recorded search page that we didn't record the page of
+MISSING_PAGE_ID = "missing"
+
+def get_content_key(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+class FixturePage():
+    def __init__(self, page_id, host, path, status, content_type, body):
+        self.page_id = page_id
+        # the host the page originally came from. each host gets its own stub
+        # server, so that per host connection pools and rate limits behave
+        # the way they would live
+        self.host = host
+        self.path = path
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+class FixtureSet():
+
+    def __init__(self, directory):
+        self.directory = directory
+        # entity -> search page html (bytes)
+        self.searches = {}
+        # page id -> FixturePage
+        self.pages = {}
+        # sha256 of the document content -> serialized response
+        self.annotations = {}
+
+    @classmethod
+    def load(cls, directory):
+        fixtures = cls(directory)
+        with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        for entity, search_path in manifest["entities"].items():
+            fixtures.searches[entity] = fixtures.read(search_path)
+
+        for page_id, page in manifest["pages"].items():
+            fixtures.pages[page_id] = FixturePage(page_id,
+                                                  page["host"],
+                                                  page["path"],
+                                                  page["status"],
+                                                  page["content_type"],
+                                                  fixtures.read(page["path"]))
+
+        annotations_directory = os.path.join(directory, ANNOTATIONS_DIRECTORY)
+        if os.path.isdir(annotations_directory):
+            for name in os.listdir(annotations_directory):
+                key, extension = os.path.splitext(name)
+                if extension == ".pb":
+                    fixtures.annotations[key] = fixtures.read(
+                        os.path.join(ANNOTATIONS_DIRECTORY, name))
+
+        return fixtures
+
+    def read(self, path):
+        with open(os.path.join(self.directory, path), "rb") as data_file:
+            return data_file.read()
+
+    def write(self, path, data):
+        path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as data_file:
+            data_file.write(data)
+
+    def save(self):
+        manifest = {"entities": {}, "pages": {}}
+        for i, (entity, search) in enumerate(sorted(self.searches.items())):
+            search_path = os.path.join(SEARCH_DIRECTORY, "{}.html".format(i))
+            self.write(search_path, search)
+            manifest["entities"][entity] = search_path
+
+        for page_id, page in self.pages.items():
+            self.write(page.path, page.body)
+            manifest["pages"][page_id] = {"host": page.host,
+                                          "path": page.path,
+                                          "status": page.status,
+                                          "content_type": page.content_type}
+
+        self.save_annotations()
+
+        self.write(MANIFEST_NAME,
+                   json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    def save_annotations(self):
+        for key, response in self.annotations.items():
+            self.write(os.path.join(ANNOTATIONS_DIRECTORY,
+                                    "{}.pb".format(key)),
+                       response)
+
+    def add_page(self, host, status, content_type, body):
+        page_id = str(len(self.pages))
+        self.pages[page_id] = FixturePage(page_id,
+                                          host,
+                                          os.path.join(PAGES_DIRECTORY,
+                                                       page_id),
+                                          status,
+                                          content_type,
+                                          body)
+        return page_id
+
+    def get_entities(self):
+        return sorted(self.searches)
+
+# some made up content to benchmark with when there aren't any recordings.
+# responses for synthetic pages get made up by the ReplayLanguageClient as
+# well, since there aren't any recorded
+SYNTHETIC_WORDS = ("the", "a", "of", "and", "to", "in", "is", "was", "for",
+                   "with", "that", "on", "as", "by", "it", "people", "said",
+                   "great", "terrible", "new", "city", "team", "work",
+                   "called", "years", "during", "after", "known", "best",
+                   "worst", "popular", "critics", "often", "however")
+SYNTHETIC_HOSTS = ("en.wikipedia.org", "www.nytimes.com", "www.reddit.com",
+                   "www.theguardian.com", "www.quora.com", "medium.com",
+                   "www.britannica.com", "www.imdb.com")
+SYNTHETIC_RESULT = '<div class="g"><a href="/url?q={}{}&amp;sa=U">' \
+                   'result</a></div>'
+
+def make_synthetic_sentence(rng, entity):
+    words = [rng.choice(SYNTHETIC_WORDS) for i in range(rng.randint(6, 20))]
+    if rng.random() < 0.4:
+        words.insert(rng.randrange(len(words)), entity)
+    return " ".join(words).capitalize() + "."
+
+def make_synthetic_page(rng, entity, num_paragraphs):
+    paragraphs = []
+    for i in range(num_paragraphs):
+        sentences = [make_synthetic_sentence(rng, entity) for j in \
+                     range(rng.randint(3, 8))]
+        paragraphs.append("<p>{}</p>".format(" ".join(sentences)))
+
+    # navigation and scripts for the cleaner and extraction to chew through
+    nav = "".join('<li><a href="/{0}">{0}</a></li>'.format(
+        rng.choice(SYNTHETIC_WORDS)) for i in range(40))
+    return ("<!DOCTYPE html><html><head><title>{0}</title>"
+            '<meta charset="utf-8"><script>var x = {1};</script>'
+            "<style>body {{ margin: 0 }}</style></head><body>"
+            "<nav><ul>{2}</ul></nav><article><h1>{0}</h1>{3}</article>"
+            "<footer>{4}</footer></body></html>").format(
+                entity,
+                rng.randint(0, 1000),
+                nav,
+                "".join(paragraphs),
+                make_synthetic_sentence(rng, "copyright")).encode()
+
+def make_synthetic_search(links):
+    results = "".join(SYNTHETIC_RESULT.format(REPLAY_LINK_PREFIX, page_id) \
+                      for page_id in links)
+    return ("<html><head><title>search</title></head><body>"
+            '<a href="/url?q=https://www.google.com/preferences">settings</a>'
+            "{}</body></html>").format(results).encode()
+
+# num_shared_pages pages (e.g. wikipedia lists) show up in every search, the
+# way popular pages do for related entities
+def synthesize(directory, num_entities=20, links_per_search=8,
+               num_shared_pages=2, seed=0):
+    rng = random.Random(seed)
+    fixtures = FixtureSet(directory)
+
+    shared_links = []
+    for i in range(num_shared_pages):
+        shared_links.append(fixtures.add_page(
+            SYNTHETIC_HOSTS[0],
+            200,
+            "text/html; charset=utf-8",
+            make_synthetic_page(rng, "List {}".format(i), 60)))
+
+    for i in range(num_entities):
+        entity = "Entity {}".format(i)
+        links = list(shared_links)
+        while len(links) < links_per_search:
+            # the odd page we can't use, like a real search would have
+            kind = rng.random()
+            if kind < 0.1:
+                status, content_type, body = 200, "application/pdf", b"%PDF"
+            elif kind < 0.15:
+                status, content_type, body = 404, "text/html", b"not found"
+            else:
+                status, content_type = 200, "text/html; charset=utf-8"
+                body = make_synthetic_page(rng, entity, rng.randint(5, 80))
+
+            links.append(fixtures.add_page(rng.choice(SYNTHETIC_HOSTS),
+                                           status,
+                                           content_type,
+                                           body))
+
+        rng.shuffle(links)
+        fixtures.searches[entity] = make_synthetic_search(links)
+
+    fixtures.save()
+    return fixtures
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# records a fixture set for bench.run, e.g.
+#   python -m bench.record --output bench/recorded "Ada Lovelace" Paris
+# the search pages and result pages get downloaded live. then, if
+# GOOGLE_APPLICATION_CREDENTIALS is set, every usable page is replayed
+# through the pipeline so that the language API's responses to exactly what
+# we'd send it get recorded too
+#   python -m bench.record --output bench/synthetic --synthetic
+# makes a synthetic set instead, without touching the network
+
+from bench.fixtures import *
+from bench.stub import ReplayServer
+from fetcher import PageFetcher
+from google.cloud import language_v1
+from sintmint import *
+import argparse
+import urllib.parse
+
+# more than NUM_LINKS_TO_CHECK, so that the pages the pipeline skips (and the
+# extra pages hedging starts on) are there to replay too
+DEFAULT_LINKS_PER_SEARCH = 8
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Record search pages, result pages and language API "
+                    "responses to benchmark against.")
+    parser.add_argument("--output",
+                        required=True,
+                        help="fixture set directory to write")
+    parser.add_argument("--links",
+                        type=int,
+                        default=DEFAULT_LINKS_PER_SEARCH,
+                        help="how many result pages to record per search")
+    parser.add_argument("--skip-annotations",
+                        action="store_true",
+                        help="only record the pages")
+    parser.add_argument("--synthetic",
+                        action="store_true",
+                        help="make up a fixture set instead of recording one")
+    parser.add_argument("entities", nargs="*")
+    args = parser.parse_args()
+
+    if not args.synthetic and not args.entities:
+        parser.error("entities are required unless --synthetic is given")
+
+    return args
+
+# records the language API's responses, while passing them through
+class RecordingLanguageClient():
+
+    def __init__(self, client, fixtures):
+        self.client = client
+        self.fixtures = fixtures
+
+    def annotate_text(self, document=None, features=None, **kwargs):
+        response = self.client.annotate_text(document=document,
+                                             features=features,
+                                             **kwargs)
+        self.fixtures.annotations[get_content_key(document.content)] = \
+            language_v1.AnnotateTextResponse.serialize(response)
+        return response
+
+def record_pages(fixtures, fetcher, entity, num_links):
+    google_search = "opinion of {}".format(entity)
+    url = GOOGLE_SEARCH_PAGE.format(urllib.parse.quote(google_search))
+    response, search = fetcher.get(url, headers={"User-Agent": "Mozilla/5.0"})
+    if response.status >= 400:
+        print("Search for {} failed with {}".format(entity, response.status))
+        return
+
+    search = search.decode()
+
+    recorded = set()
+    for link in get_result_links(search):
+        if link in recorded:
+            continue
+        recorded.add(link)
+
+        page_id = MISSING_PAGE_ID
+        if len(recorded) <= num_links:
+            print(link)
+            try:
+                response, body = fetcher.get(
+                    link,
+                    headers={"User-Agent": DEFAULT_USER_AGENT,
+                             "Accept": DEFAULT_ACCEPT},
+                    max_retries=RESULT_PAGE_MAX_RETRIES)
+            except urllib3.exceptions.HTTPError as err:
+                print("Failed to download {}: {!r}".format(link, err))
+            else:
+                page_id = fixtures.add_page(
+                    urllib.parse.urlsplit(link).netloc,
+                    response.status,
+                    response.headers.get("content-type", ""),
+                    body)
+
+        search = search.replace("/url?q=" + link,
+                                "/url?q=" + REPLAY_LINK_PREFIX + page_id)
+
+    fixtures.searches[entity] = search.encode()
+
+def record_annotations(fixtures):
+    server = ReplayServer(fixtures)
+    try:
+        sintmint = SintMint(hedged=False, search_page=server.search_page)
+        sintmint.client = RecordingLanguageClient(sintmint.get_client(),
+                                                  fixtures)
+
+        for entity in fixtures.get_entities():
+            print("Annotating pages for {}".format(entity))
+            links = sintmint.get_search_links(entity)
+            # every usable page, not just the first few
+            sintmint.get_text_infos(links, entity, num_links=len(links))
+    finally:
+        server.close()
+
+def main():
+    args = parse_args()
+
+    if args.synthetic:
+        synthesize(args.output)
+        return
+
+    fixtures = FixtureSet(args.output)
+    fetcher = PageFetcher()
+    for entity in args.entities:
+        record_pages(fixtures, fetcher, entity, args.links)
+    fixtures.save()
+
+    if args.skip_annotations or \
+       not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
+        print("Not recording annotations, responses will be made up when "
+              "replaying")
+        return
+
+    record_annotations(fixtures)
+    fixtures.save_annotations()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# replays a fixture set through the whole pipeline and reports latency,
+# per stage timings, throughput and peak memory, e.g.
+#   python -m bench.run --page-latency 0.2 --annotate-latency 0.3
+#   python -m bench.run --json before.json
+#   python -m bench.run --baseline before.json
+# without --fixtures, a synthetic fixture set gets made in a temporary
+# directory
+
+from bench.fixtures import FixtureSet, synthesize
+from bench.stub import ReplayServer, ReplayLanguageClient
+from metrics import Trace
+from page_cache import PageCache
+from ratelimit import TokenBucket
+from sintmint import *
+from collections import defaultdict
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# (result path, whether bigger is better) of the numbers compared against a
+# baseline
+COMPARED_RESULTS = (("single.latency.p50", False),
+                    ("single.latency.p95", False),
+                    ("batch.entities_per_second", True),
+                    ("single.language_cost_per_query", False),
+                    ("single.peak_memory_mb", False),
+                    ("batch.peak_memory_mb", False))
+DEFAULT_MAX_REGRESSION = 0.1
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scoring pipeline against recorded or "
+                    "synthetic fixtures, without the network.")
+    parser.add_argument("--fixtures",
+                        help="fixture set directory (see bench/record.py)")
+    parser.add_argument("--benchmark",
+                        choices=("single", "batch", "all"),
+                        default="all")
+    parser.add_argument("--queries",
+                        type=int,
+                        default=10,
+                        help="how many single queries to time")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        help="how many entities to score in the batch. "
+                             "defaults to every entity in the fixtures once")
+    parser.add_argument("--batch-workers",
+                        type=int,
+                        default=DEFAULT_BATCH_WORKERS)
+    parser.add_argument("--fetch-workers",
+                        type=int,
+                        default=DEFAULT_FETCH_WORKERS)
+    parser.add_argument("--annotate-workers",
+                        type=int,
+                        default=DEFAULT_ANNOTATE_WORKERS)
+    parser.add_argument("--clean-workers",
+                        type=int,
+                        default=DEFAULT_CLEAN_WORKERS,
+                        help="processes cleaning pages (0 cleans them on the "
+                             "fetch threads)")
+    parser.add_argument("--tier",
+                        choices=ANALYSIS_TIERS,
+                        default=DEFAULT_ANALYSIS_TIER,
+                        help="analysis tier to benchmark")
+    parser.add_argument("--hedged",
+                        action="store_true",
+                        help="use whichever usable pages come back first "
+                             "instead of the first ones in the search "
+                             "results")
+    parser.add_argument("--pack",
+                        action="store_true",
+                        help="pack small pages into shared annotate_text "
+                             "requests")
+    parser.add_argument("--page-latency",
+                        type=float,
+                        default=0.1,
+                        help="seconds before every page starts coming back")
+    parser.add_argument("--page-jitter",
+                        type=float,
+                        default=0.1,
+                        help="up to this many more seconds for each page")
+    parser.add_argument("--page-bytes-per-second",
+                        type=float,
+                        help="how fast page bodies come in")
+    parser.add_argument("--annotate-latency",
+                        type=float,
+                        default=0.3,
+                        help="seconds each annotate_text call takes")
+    parser.add_argument("--annotate-latency-per-kb",
+                        type=float,
+                        default=0.002,
+                        help="more seconds per KB of annotated content")
+    parser.add_argument("--search-rate",
+                        type=float,
+                        default=GOOGLE_SEARCH_RATE,
+                        help="google searches per second we allow ourselves")
+    parser.add_argument("--page-cache",
+                        action="store_true",
+                        help="keep search and result pages in a page cache "
+                             "(in a temporary directory)")
+    parser.add_argument("--warmup",
+                        type=int,
+                        default=1,
+                        help="untimed queries to run first")
+    parser.add_argument("--memory",
+                        action="store_true",
+                        help="track peak python memory with tracemalloc "
+                             "(which slows everything else down)")
+    parser.add_argument("--json",
+                        help="write the results here")
+    parser.add_argument("--baseline",
+                        help="results from an earlier --json run to compare "
+                             "against. exits with 1 on a regression")
+    parser.add_argument("--max-regression",
+                        type=float,
+                        default=DEFAULT_MAX_REGRESSION,
+                        help="how much worse than the baseline (as a "
+                             "fraction) counts as a regression")
+    return parser.parse_args()
+
+def get_percentile(values, percentile):
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, percentile))
+
+def summarize(values):
+    return {"count": len(values),
+            "mean": float(np.mean(values)) if values else None,
+            "p50": get_percentile(values, 50),
+            "p95": get_percentile(values, 95),
+            "max": max(values) if values else None}
+
+def summarize_stages(traces):
+    # stage -> seconds of every time it happened, across all of the traces
+    stage_seconds = defaultdict(list)
+    skips = defaultdict(int)
+    for trace in traces:
+        for event in trace.to_json():
+            if "seconds" in event:
+                stage_seconds[event["event"]].append(event["seconds"])
+            elif event["event"] == "skip":
+                skips[event["reason"]] += 1
+
+    return ({stage: summarize(seconds) for stage, seconds in \
+             sorted(stage_seconds.items())},
+            dict(skips))
+
+def make_sintmint(args, server, client, page_cache=None):
+    sintmint = SintMint(fetch_workers=args.fetch_workers,
+                        annotate_workers=args.annotate_workers,
+                        clean_workers=args.clean_workers,
+                        hedged=args.hedged,
+                        analysis_tier=args.tier,
+                        pack_documents=args.pack,
+                        client=client,
+                        page_cache=page_cache,
+                        search_page=server.search_page)
+    sintmint.search_bucket = TokenBucket(args.search_rate,
+                                         GOOGLE_SEARCH_BURST)
+    return sintmint
+
+# each benchmark starts out with an empty page cache of its own
+def make_page_cache(args, directory, name):
+    if not args.page_cache:
+        return None
+    return PageCache(os.path.join(directory, "page_cache", name))
+
+class MemoryTracker():
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if self.enabled:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.peak_mb = None
+        if self.enabled:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+def get_language_cost(sintmint):
+    return sum(sintmint.metrics.get_language_costs().values())
+
+# returns whether the entity got a score, since an entity none of whose pages
+# could be used is part of the benchmark rather than a reason to stop it
+def score_single(sintmint, target_entity, trace=None):
+    try:
+        sintmint.get_sentiment_score(target_entity, trace=trace)
+    except NoUsablePagesError:
+        return False
+
+    return True
+
+def run_single(args, server, client, entities, page_cache=None):
+    sintmint = make_sintmint(args, server, client, page_cache)
+    for i in range(args.warmup):
+        score_single(sintmint, entities[i % len(entities)])
+    start_cost = get_language_cost(sintmint)
+
+    latencies = []
+    traces = []
+    num_failed = 0
+    with MemoryTracker(args.memory) as memory:
+        for i in range(args.queries):
+            trace = Trace()
+            start = time.perf_counter()
+            if not score_single(sintmint,
+                                entities[i % len(entities)],
+                                trace):
+                num_failed += 1
+            latencies.append(time.perf_counter() - start)
+            traces.append(trace)
+
+    stages, skips = summarize_stages(traces)
+    cost = get_language_cost(sintmint) - start_cost
+    return {"latency": summarize(latencies),
+            "failed": num_failed,
+            "language_cost_per_query": cost / max(1, args.queries),
+            "stages": stages,
+            "skipped_pages": skips,
+            "peak_memory_mb": memory.peak_mb}
+
+def run_batch(args, server, client, entities, page_cache=None):
+    sintmint = make_sintmint(args, server, client, page_cache)
+    for i in range(args.warmup):
+        score_single(sintmint, entities[i % len(entities)])
+
+    batch_size = args.batch_size
+    if batch_size is None:
+        batch_size = len(entities)
+    batch = [entities[i % len(entities)] for i in range(batch_size)]
+    start_cost = get_language_cost(sintmint)
+    traces = {}
+    num_scored = 0
+    with MemoryTracker(args.memory) as memory:
+        start = time.perf_counter()
+        for result in sintmint.get_sentiment_scores(batch,
+                                                    args.batch_workers,
+                                                    traces):
+            num_scored += 1
+        seconds = time.perf_counter() - start
+
+    stages, skips = summarize_stages(traces.values())
+    return {"entities": len(batch),
+            "scored": num_scored,
+            "seconds": seconds,
+            "entities_per_second": num_scored / seconds,
+            "language_cost": get_language_cost(sintmint) - start_cost,
+            "stages": stages,
+            "skipped_pages": skips,
+            "peak_memory_mb": memory.peak_mb}
+
+def get_result(results, path):
+    for key in path.split("."):
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    for path, bigger_is_better in COMPARED_RESULTS:
+        value = get_result(results, path)
+        baseline_value = get_result(baseline, path)
+        if value is None or not baseline_value:
+            continue
+
+        change = (value - baseline_value) / baseline_value
+        if bigger_is_better:
+            change = -change
+
+        print("{:<30} {:>10.4f} (baseline {:.4f}, {:.1%} {})".format(
+            path,
+            value,
+            baseline_value,
+            abs(change),
+            "worse" if change > 0 else "better"))
+        if change > max_regression:
+            regressions.append(path)
+
+    return regressions
+
+def print_results(name, results):
+    print("== {}".format(name))
+    for key, value in results.items():
+        if key == "stages":
+            print("stages (seconds):")
+            for stage, summary in value.items():
+                print("  {:<10} n={:<5} mean={:.4f} p50={:.4f} "
+                      "p95={:.4f}".format(stage,
+                                          summary["count"],
+                                          summary["mean"],
+                                          summary["p50"],
+                                          summary["p95"]))
+        elif isinstance(value, dict):
+            print("{}: {}".format(key, json.dumps(value)))
+        else:
+            print("{}: {}".format(key, value))
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.fixtures is None:
+            fixtures = synthesize(directory)
+        else:
+            fixtures = FixtureSet.load(args.fixtures)
+
+        entities = fixtures.get_entities()
+        server = ReplayServer(fixtures,
+                              latency=args.page_latency,
+                              jitter=args.page_jitter,
+                              bytes_per_second=args.page_bytes_per_second)
+        client = ReplayLanguageClient(
+            fixtures,
+            latency=args.annotate_latency,
+            latency_per_kb=args.annotate_latency_per_kb)
+
+        results = {"config": vars(args)}
+        try:
+            if args.benchmark in ("single", "all"):
+                results["single"] = run_single(
+                    args,
+                    server,
+                    client,
+                    entities,
+                    make_page_cache(args, directory, "single"))
+                print_results("single", results["single"])
+
+            if args.benchmark in ("batch", "all"):
+                results["batch"] = run_batch(
+                    args,
+                    server,
+                    client,
+                    entities,
+                    make_page_cache(args, directory, "batch"))
+                print_results("batch", results["batch"])
+        finally:
+            server.close()
+
+    results["requests"] = dict(server.requests)
+    results["annotate_calls"] = dict(client.calls)
+    # high water mark for the whole process, including the fixtures
+    results["max_rss_mb"] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("requests: {}".format(results["requests"]))
+    print("annotate calls: {}".format(results["annotate_calls"]))
+    print("max rss: {:.1f} MB".format(results["max_rss_mb"]))
+
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        print("== compared to {}".format(args.baseline))
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print("Regressed: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from bench.fixtures import *
+from collections import Counter, defaultdict
+from google.cloud import language_v1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+# what the search page handler serves, with a {} for the search terms
+SEARCH_PATH = "/search?q={}"
+PAGE_PATH = "/page/{}"
+
+# how the pipeline phrases its searches, see SintMint.get_search_links
+SEARCH_PREFIX = "opinion of "
+
+PAGE_WRITE_SIZE = 16 * 1024
+
+SENTENCE_PATTERN = re.compile(r"[^.!?]+[.!?]*")
+ENTITY_PATTERN = re.compile(r"\b[A-Z][\w]*(?: [A-Z0-9][\w]*)*")
+POSITIVE_WORDS = frozenset(["great", "best", "popular", "good", "love"])
+NEGATIVE_WORDS = frozenset(["terrible", "worst", "bad", "hate", "awful"])
+SYNTHETIC_CATEGORIES = ("/People & Society/Social Issues & Advocacy",
+                        "/Arts & Entertainment/Celebrities & Entertainment "
+                        "News",
+                        "/News/Politics",
+                        "/Travel/Tourist Destinations")
+MAX_SYNTHETIC_ENTITIES = 50
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the sites we'd actually be downloading from
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.replay.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+class ReplayHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the pipeline hangs up on pages it no longer needs, which is fine
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+# serves the search pages and result pages of a FixtureSet on localhost. each
+# of the pages' original hosts gets its own port, so that the pipeline sees
+# them as different hosts
+# latency is how long every response takes to start, plus up to jitter more.
+# bytes_per_second, if given, throttles how fast the bodies come in
+class ReplayServer():
+
+    def __init__(self, fixtures, latency=0.0, jitter=0.0,
+                 bytes_per_second=None, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.bytes_per_second = bytes_per_second
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+
+        self.servers = {}
+        self.search_server = self.start_server()
+        for page in fixtures.pages.values():
+            if page.host not in self.servers:
+                self.servers[page.host] = self.start_server()
+
+        self.search_page = self.get_url(self.search_server) + SEARCH_PATH
+
+    def start_server(self):
+        server = ReplayHTTPServer(("127.0.0.1", 0), ReplayHandler)
+        server.replay = self
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    def get_url(self, server):
+        return "http://127.0.0.1:{}".format(server.server_port)
+
+    def get_page_link(self, page_id):
+        page = self.fixtures.pages.get(page_id)
+        if page is None:
+            return "/url?q=http://127.0.0.1:1/missing"
+
+        return "/url?q=" + self.get_url(self.servers[page.host]) + \
+            PAGE_PATH.format(page_id)
+
+    def close(self):
+        for server in [self.search_server] + list(self.servers.values()):
+            server.shutdown()
+            server.server_close()
+
+    def wait(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, handler):
+        self.wait()
+
+        url = urllib.parse.urlsplit(handler.path)
+        if handler.server is self.search_server and url.path == "/search":
+            self.count("search")
+            self.handle_search(handler, url)
+            return
+
+        page_id = url.path[len(PAGE_PATH.format("")):]
+        page = self.fixtures.pages.get(page_id)
+        if not url.path.startswith(PAGE_PATH.format("")) or page is None:
+            self.count("missing")
+            self.send(handler, 404, "text/html", b"not found")
+            return
+
+        # so that conditional GETs from the page cache can be replayed too
+        etag = '"{}"'.format(get_content_key(page.page_id)[:16])
+        if page.status == 200 and \
+           handler.headers.get("If-None-Match") == etag:
+            self.count("not_modified")
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.end_headers()
+            return
+
+        self.count("page")
+        self.send(handler,
+                  page.status,
+                  page.content_type,
+                  page.body,
+                  {"ETag": etag})
+
+    def handle_search(self, handler, url):
+        terms = urllib.parse.parse_qs(url.query).get("q", [""])[0]
+        if terms.startswith(SEARCH_PREFIX):
+            terms = terms[len(SEARCH_PREFIX):]
+
+        search = self.fixtures.searches.get(terms)
+        if search is None:
+            self.send(handler, 404, "text/html", b"not found")
+            return
+
+        search = REPLAY_LINK_PATTERN.sub(
+            lambda match: self.get_page_link(match.group(1)),
+            search.decode())
+        self.send(handler,
+                  200,
+                  "text/html; charset=utf-8",
+                  search.encode())
+
+    def send(self, handler, status, content_type, body, headers={}):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+
+        try:
+            if self.bytes_per_second is None:
+                handler.wfile.write(body)
+                return
+
+            for start in range(0, len(body), PAGE_WRITE_SIZE):
+                chunk = body[start:start + PAGE_WRITE_SIZE]
+                handler.wfile.write(chunk)
+                handler.wfile.flush()
+                time.sleep(len(chunk) / self.bytes_per_second)
+        except ConnectionError:
+            # the pipeline gave up on the page part way through
+            pass
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+
+# stands in for language_v1.LanguageServiceClient. responses recorded for the
+# exact content being annotated get replayed, and anything else gets a made
+# up response with roughly the shape (and size) a real one would have
+# each call takes latency seconds, plus latency_per_kb for every KB of
+# content, like the real API roughly does
+class ReplayLanguageClient():
+
+    def __init__(self, fixtures, latency=0.0, latency_per_kb=0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.latency_per_kb = latency_per_kb
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        # content key -> serialized synthetic response
+        self.synthetic = {}
+
+    def annotate_text(self, document=None, features=None, retry=None,
+                      timeout=None, **kwargs):
+        content = document.content
+        delay = self.latency + self.latency_per_kb * len(content) / 1024
+        if delay > 0:
+            time.sleep(delay)
+
+        key = get_content_key(content)
+        response = self.fixtures.annotations.get(key)
+        with self.lock:
+            if response is not None:
+                self.calls["recorded"] += 1
+            else:
+                self.calls["synthetic"] += 1
+                response = self.synthetic.get(key)
+
+        if response is None:
+            response = language_v1.AnnotateTextResponse.serialize(
+                self.make_response(content, features or {}))
+            with self.lock:
+                self.synthetic[key] = response
+
+        response = language_v1.AnnotateTextResponse.deserialize(response)
+        if key in self.fixtures.annotations:
+            self.strip_response(response, features or {})
+        return response
+
+    # recordings can have more in them than was asked for this time (e.g.
+    # recorded with everything, replayed with just sentiment)
+    def strip_response(self, response, features):
+        if not features.get("extract_entities") and \
+           not features.get("extract_entity_sentiment"):
+            del response.entities[:]
+        if not features.get("classify_text"):
+            del response.categories[:]
+        if not features.get("extract_document_sentiment"):
+            response.document_sentiment = None
+            del response.sentences[:]
+
+    def get_sentence_sentiment(self, sentence):
+        words = sentence.lower().split()
+        score = 0.1 * (sum(word.strip(".,") in POSITIVE_WORDS for word in \
+                           words) - \
+                       sum(word.strip(".,") in NEGATIVE_WORDS for word in \
+                           words))
+        score = max(-1.0, min(1.0, score))
+        return score, abs(score) + 0.1 * (len(words) > 10)
+
+    def make_response(self, content, features):
+        sentences = []
+        for match in SENTENCE_PATTERN.finditer(content):
+            text = match.group(0).strip()
+            if not text:
+                continue
+
+            begin_offset = match.start() + \
+                len(match.group(0)) - len(match.group(0).lstrip())
+            score, magnitude = self.get_sentence_sentiment(text)
+            sentences.append({"text": {"content": text,
+                                       "begin_offset": begin_offset},
+                              "sentiment": {"score": score,
+                                            "magnitude": magnitude}})
+
+        response = {"sentences": sentences, "language": "en"}
+
+        if features.get("extract_document_sentiment"):
+            scores = [sentence["sentiment"]["score"] for sentence in \
+                      sentences]
+            response["document_sentiment"] = {
+                "score": sum(scores) / max(1, len(scores)),
+                "magnitude": sum(abs(score) for score in scores)}
+
+        if features.get("extract_entities") or \
+           features.get("extract_entity_sentiment"):
+            response["entities"] = self.make_entities(sentences)
+
+        if features.get("classify_text"):
+            category = SYNTHETIC_CATEGORIES[
+                len(content) % len(SYNTHETIC_CATEGORIES)]
+            response["categories"] = [{"name": category,
+                                       "confidence": 0.6}]
+
+        return language_v1.AnnotateTextResponse(response)
+
+    def make_entities(self, sentences):
+        mentions = defaultdict(list)
+        for sentence in sentences:
+            text = sentence["text"]
+            for match in ENTITY_PATTERN.finditer(text["content"]):
+                mentions[match.group(0)].append(
+                    {"text": {"content": match.group(0),
+                              "begin_offset": text["begin_offset"] + \
+                                  match.start()},
+                     "sentiment": dict(sentence["sentiment"])})
+
+        total_mentions = sum(len(entity_mentions) for entity_mentions in \
+                             mentions.values())
+        entities = []
+        for name, entity_mentions in sorted(
+                mentions.items(),
+                key=lambda item: len(item[1]),
+                reverse=True)[:MAX_SYNTHETIC_ENTITIES]:
+            scores = [mention["sentiment"]["score"] for mention in \
+                      entity_mentions]
+
+            # google leaves some entities without a score of their own, so
+            # that the mentions have to be looked at instead
+            score = 0.0
+            if len(name) % 2 == 0:
+                score = sum(scores) / len(scores)
+
+            entities.append({
+                "name": name,
+                "salience": len(entity_mentions) / total_mentions,
+                "sentiment": {"score": score,
+                              "magnitude": sum(abs(score) for score in \
+                                               scores)},
+                "mentions": entity_mentions})
+
+        return entities
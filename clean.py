@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# cleaning up a page and pulling its text out is all CPU, and lxml and the
+# extraction hold on to the GIL for most of it, so this runs in a pool of
+# processes of its own (see SintMint.clean_page) rather than on the threads
+# downloading pages and serving requests
+
+from extract import extract_main_text
+import lxml.etree
+import lxml.html
+import threading
+import time
+
+# made once per process, the first time it's needed (or when a worker
+# starts, see init_worker)
+cleaner = None
+cleaner_lock = threading.Lock()
+
+# for pages that have already been decoded, whatever they say their encoding
+# is
+UTF8_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+# cleaning only changes the tree it's given, never the Cleaner itself, so
+# every thread can share the one
+def get_cleaner():
+    global cleaner
+    with cleaner_lock:
+        if cleaner is None:
+            from lxml.html.clean import Cleaner
+
+            cleaner = Cleaner(page_structure=True,
+                              scripts=True,
+                              javascript=True,
+                              comments=True,
+                              style=True,
+                              inline_style=True,
+                              links=True,
+                              meta=True,
+                              processing_instructions=True,
+                              embedded=True,
+                              frames=True,
+                              forms=True,
+                              annoying_tags=True,
+                              safe_attrs_only=True,
+                              safe_attrs=frozenset())
+
+        return cleaner
+
+# for the process pool, so that no page has to wait on the import
+def init_worker():
+    get_cleaner()
+
+def parse_page(page_contents):
+    try:
+        return lxml.html.fromstring(page_contents)
+    except ValueError:
+        # lxml won't take a str that starts with an encoding declaration
+        # (e.g. <?xml version="1.0" encoding="ISO-8859-1"?> on XHTML pages),
+        # so it gets the bytes back along with what they really are
+        return lxml.html.fromstring(page_contents.encode("utf-8"),
+                                    parser=UTF8_PARSER)
+
+# returns (cleaned contents, {stage: seconds}), where the contents are the
+# main text of the page if as_text, or otherwise the cleaned html. the
+# contents are None if there's nothing in the page at all
+def clean_page(page_contents, as_text=True):
+    stage_seconds = {}
+
+    start = time.perf_counter()
+    try:
+        page_tree = parse_page(page_contents)
+    except lxml.etree.ParserError:
+        page_tree = None
+    else:
+        get_cleaner()(page_tree)
+    stage_seconds["clean"] = time.perf_counter() - start
+
+    if page_tree is None:
+        return None, stage_seconds
+
+    start = time.perf_counter()
+    if as_text:
+        page_contents = extract_main_text(page_tree)
+    else:
+        page_contents = lxml.html.tostring(page_tree, encoding="unicode")
+    stage_seconds["extract"] = time.perf_counter() - start
+
+    return page_contents, stage_seconds
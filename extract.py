@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# pulls the main content of a page out as plain text, loosely based on the
+# heuristics from arc90's readability: paragraphs of real text vote for the
+# element that contains them, and we keep the text under the element with the
+# most votes, leaving behind navigation, footers, link lists, etc.
+
+from collections import defaultdict
+
+# elements that start a new block of text when rendered
+BLOCK_TAGS = frozenset([
+    "address", "article", "aside", "blockquote", "body", "dd", "div", "dl",
+    "dt", "figcaption", "footer", "h1", "h2", "h3", "h4", "h5", "h6",
+    "header", "li", "main", "nav", "ol", "p", "pre", "section", "table",
+    "tbody", "td", "th", "thead", "tr", "ul"])
+
+# blocks shorter than this (e.g. menu entries, buttons, bylines) don't count
+# as evidence of where the content is
+MIN_BLOCK_LENGTH = 25
+
+# blocks that are mostly link text are navigation or "related articles"
+MAX_LINK_DENSITY = 0.5
+
+# siblings of the best candidate with at least this fraction of its score
+# get included as well
+SIBLING_SCORE_RATIO = 0.2
+
+class TextBlock():
+    def __init__(self, element, text, link_length):
+        self.element = element
+        self.text = text
+        self.link_length = link_length
+
+    def get_link_density(self):
+        if len(self.text) == 0:
+            return 0.0
+
+        return float(self.link_length) / len(self.text)
+
+def get_inline_text(element):
+    # text of an inline element (and its children), along with how much of
+    # it is link text
+    text = element.text_content()
+    link_length = len(text) if element.tag == "a" else \
+        sum(len(link.text_content()) for link in element.iter("a"))
+    return text, link_length
+
+def get_own_text(element):
+    # text that belongs directly to this block, not counting any blocks
+    # nested within it, which get their own TextBlock
+    parts = [element.text or ""]
+    link_length = 0
+    for child in element:
+        if not isinstance(child.tag, str):
+            # comments and processing instructions, which only have a tail
+            parts.append(child.tail or "")
+            continue
+
+        if child.tag not in BLOCK_TAGS:
+            text, child_link_length = get_inline_text(child)
+            parts.append(text)
+            link_length += child_link_length
+
+        parts.append(child.tail or "")
+
+    text = " ".join("".join(parts).split())
+    return text, min(link_length, len(text))
+
+def get_text_blocks(root):
+    blocks = []
+    for element in root.iter():
+        if not isinstance(element.tag, str) or element.tag not in BLOCK_TAGS:
+            continue
+
+        text, link_length = get_own_text(element)
+        if text:
+            blocks.append(TextBlock(element, text, link_length))
+
+    # the root might just be a single block of text without any structure
+    if not blocks:
+        text = " ".join(root.text_content().split())
+        if text:
+            blocks.append(TextBlock(root, text, 0))
+
+    return blocks
+
+def is_content_block(block):
+    return len(block.text) >= MIN_BLOCK_LENGTH and \
+           block.get_link_density() <= MAX_LINK_DENSITY
+
+def get_candidate_scores(blocks):
+    scores = defaultdict(float)
+    for block in blocks:
+        if not is_content_block(block):
+            continue
+
+        # longer paragraphs with more clauses are more likely to be the
+        # actual content of the page
+        score = 1 + block.text.count(",") + min(len(block.text) / 100, 3)
+
+        # the parent and grandparent of the block get a vote, so that the
+        # element holding most of the paragraphs ends up with the best score
+        element = block.element.getparent()
+        for weight in (1.0, 0.5):
+            if element is None:
+                break
+
+            scores[element] += score * weight
+            element = element.getparent()
+
+    return scores
+
+def is_within(element, ancestors):
+    while element is not None:
+        if element in ancestors:
+            return True
+        element = element.getparent()
+
+    return False
+
+def extract_main_text(root):
+    blocks = get_text_blocks(root)
+    scores = get_candidate_scores(blocks)
+    if not scores:
+        return "\n\n".join(block.text for block in blocks)
+
+    best_candidate = max(scores, key=scores.get)
+
+    # articles are often split over sibling containers (e.g. around an ad or
+    # an image), so pull in siblings that also scored well
+    included = set([best_candidate])
+    parent = best_candidate.getparent()
+    if parent is not None:
+        min_score = scores[best_candidate] * SIBLING_SCORE_RATIO
+        for sibling in parent:
+            if scores.get(sibling, 0) >= min_score:
+                included.add(sibling)
+
+    content = [block.text for block in blocks if \
+               is_within(block.element, included) and \
+               block.get_link_density() <= MAX_LINK_DENSITY]
+
+    return "\n\n".join(content)
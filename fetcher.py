@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+import urllib3
+from email.message import Message
+from ratelimit import *
+import time
+
+# a slow site shouldn't be able to hold on to one of our workers forever
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 10.0
+
+DEFAULT_MAX_REDIRECTS = 5
+
+# how many hosts we keep connections open to, and how many connections we
+# keep open per host
+DEFAULT_NUM_POOLS = 100
+DEFAULT_POOL_SIZE = 8
+
+# if an upstream wants us to wait longer than this before retrying, we're
+# better off giving up on it
+DEFAULT_MAX_RETRY_WAIT = 10.0
+
+# statuses that mean we're going too fast, as opposed to the server just
+# having problems
+THROTTLE_STATUSES = frozenset([429, 503])
+
+# urllib3 transparently decompresses these for us
+DEFAULT_ACCEPT_ENCODING = "gzip, deflate"
+
+def get_header_charset(content_type):
+    message = Message()
+    message["content-type"] = content_type or ""
+    return message.get_content_charset()
+
+# shared by every query in the process, so that repeat requests to the same
+# host (google itself, wikipedia, news sites) reuse open keep-alive
+# connections instead of doing a new TCP and TLS handshake every time
+class PageFetcher():
+
+    def __init__(self,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_redirects=DEFAULT_MAX_REDIRECTS,
+                 num_pools=DEFAULT_NUM_POOLS,
+                 pool_size=DEFAULT_POOL_SIZE):
+        # retrying on statuses happens in open, so the only thing urllib3's
+        # Retry is doing is following (and limiting) redirects. left to
+        # itself, it would also sleep for however long Retry-After says
+        retries = urllib3.Retry(total=max_redirects,
+                                connect=0,
+                                read=0,
+                                redirect=max_redirects,
+                                raise_on_redirect=True,
+                                respect_retry_after_header=False)
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        # block=False means that a host with more concurrent requests than
+        # pool_size still gets them, we just don't keep the extra connections
+        # around afterwards
+        self.pool = urllib3.PoolManager(
+            num_pools=num_pools,
+            maxsize=pool_size,
+            block=False,
+            timeout=urllib3.Timeout(connect=connect_timeout,
+                                    read=read_timeout),
+            retries=retries,
+            headers={"Accept-Encoding": DEFAULT_ACCEPT_ENCODING})
+
+    # returns the response as soon as the headers are in, so that the body
+    # can be streamed (or skipped). the response has to be given back to
+    # release once we're done with it
+    # if a bucket is given, requests wait on it first, and slow it down when
+    # the upstream tells us to. responses with a retryable status are retried
+    # with backoff (or after however long Retry-After says), and the last
+    # one is returned if they never succeed
+    # deadline (in time.monotonic() terms) caps the timeouts, retries and
+    # waiting on the bucket so that we're done by then one way or another,
+    # and setting cancelled (an Event) stops the waiting on the bucket early.
+    # either one raises urllib3's TimeoutError
+    def open(self, url, headers, bucket=None,
+             max_retries=DEFAULT_MAX_RETRIES,
+             max_retry_wait=DEFAULT_MAX_RETRY_WAIT,
+             deadline=None,
+             cancelled=None):
+        headers = dict(headers)
+        headers.setdefault("Accept-Encoding", DEFAULT_ACCEPT_ENCODING)
+
+        attempt = 0
+        while True:
+            if bucket is not None and \
+               not bucket.acquire(deadline, cancelled):
+                raise urllib3.exceptions.TimeoutError(
+                    "Rate limited past the deadline for {}".format(url))
+
+            response = self.pool.request("GET",
+                                         url,
+                                         headers=headers,
+                                         preload_content=False,
+                                         decode_content=True,
+                                         timeout=self.get_timeout(deadline))
+            if response.status not in RETRYABLE_STATUSES:
+                if bucket is not None:
+                    bucket.on_success()
+                return response
+
+            retry_after = parse_retry_after(
+                response.headers.get("retry-after"))
+            throttled = bucket is not None and \
+                response.status in THROTTLE_STATUSES
+            if throttled:
+                bucket.on_throttle(retry_after)
+
+            wait = retry_after
+            if wait is None:
+                wait = get_backoff(attempt)
+
+            if attempt >= max_retries or wait > max_retry_wait or \
+               (deadline is not None and time.monotonic() + wait > deadline):
+                return response
+
+            self.release(response)
+
+            # a throttled bucket already holds us (and everybody else going
+            # to this upstream) back until Retry-After has passed
+            if not throttled or retry_after is None:
+                time.sleep(wait)
+            attempt += 1
+
+    def get_timeout(self, deadline):
+        if deadline is None:
+            return urllib3.Timeout(connect=self.connect_timeout,
+                                   read=self.read_timeout)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise urllib3.exceptions.TimeoutError(
+                "Deadline passed before the request was sent")
+
+        return urllib3.Timeout(connect=min(self.connect_timeout, remaining),
+                               read=min(self.read_timeout, remaining))
+
+    def release(self, response):
+        # a connection can only go back into the pool once its body has been
+        # read all the way through, otherwise the rest of the body would get
+        # read as the next response on it
+        if not response.closed:
+            response.close()
+        response.release_conn()
+
+    def get(self, url, headers, bucket=None,
+            max_retries=DEFAULT_MAX_RETRIES,
+            max_retry_wait=DEFAULT_MAX_RETRY_WAIT,
+            deadline=None):
+        response = self.open(url,
+                             headers,
+                             bucket,
+                             max_retries,
+                             max_retry_wait,
+                             deadline)
+        try:
+            data = response.read()
+        finally:
+            self.release(response)
+
+        return response, data
@@ -1,6 +1,19 @@
 #!/usr/bin/env python3
 # Author: Antony Toron
 
+import numpy as np
+import math
+import re
+
+# where text can be split up, from most to least preferred: between
+# paragraphs, between lines, between sentences and between words. the
+# boundary stays with the piece before it, so that the pieces join back up
+# into exactly the original text
+CHUNK_BOUNDARIES = (re.compile(r"(?<=\n\n)"),
+                    re.compile(r"(?<=\n)"),
+                    re.compile(r"(?<=[.!?]\s)"),
+                    re.compile(r"(?<=\s)"))
+
 def equal_with_tolerance(a, b, tolerance=0.00001):
     return abs(a-b) <= tolerance
 
@@ -8,10 +21,55 @@ def get_weighted_average(values, weights):
     if len(values) == 0:
         return 0.0
 
-    numerator = sum([values[i] * weights[i] for i in range(len(values))])
-    denominator = sum(weights)
+    weights = np.asarray(weights, dtype=float)
+    numerator = np.dot(np.asarray(values, dtype=float), weights)
+    denominator = weights.sum()
 
     if equal_with_tolerance(denominator, 0.0):
         return 0.0
 
-    return numerator / denominator
+    return float(numerator / denominator)
+
+def split_into_pieces(text, max_size, level=0):
+    if len(text) <= max_size:
+        return [text]
+
+    # nowhere left to split it nicely
+    if level == len(CHUNK_BOUNDARIES):
+        return [text[i:i + max_size] for i in range(0, len(text), max_size)]
+
+    pieces = []
+    for piece in CHUNK_BOUNDARIES[level].split(text):
+        if piece:
+            pieces.extend(split_into_pieces(piece, max_size, level + 1))
+
+    return pieces
+
+# splits text into roughly even chunks of at most max_size, at the nicest
+# boundaries we can
+def split_into_chunks(text, max_size):
+    if len(text) <= max_size:
+        return [text]
+
+    target_size = len(text) / math.ceil(len(text) / max_size)
+
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for piece in split_into_pieces(text, max_size):
+        if chunk and (chunk_size >= target_size or \
+                      chunk_size + len(piece) > max_size):
+            chunks.append("".join(chunk))
+            chunk = []
+            chunk_size = 0
+
+        chunk.append(piece)
+        chunk_size += len(piece)
+
+    chunks.append("".join(chunk))
+    return chunks
+
+def normalize_entity(entity):
+    # so that "Barack Obama", "barack obama" and " Barack  Obama" all end up
+    # pointing at the same stored results
+    return " ".join(entity.lower().split())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from helpers import *
+import threading
+import time
+import uuid
+
+JOB_PENDING = "pending"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# how many queries we work on at once in the background. they share one
+# SintMint, and mostly spend their time waiting on its pools
+DEFAULT_JOB_WORKERS = 8
+
+# finished jobs are kept around for a while so that their results can be
+# picked up, and then dropped (oldest first) once we have too many
+DEFAULT_MAX_FINISHED_JOBS = 1000
+DEFAULT_FINISHED_JOB_TTL = 60 * 60
+
+class Job():
+    def __init__(self, job_id, target_entity, future=None, trace=None):
+        self.job_id = job_id
+        self.target_entity = target_entity
+        self.future = future
+        self.trace = trace
+        self.created = time.time()
+
+        # progress updates from the query so far, for anything streaming
+        # them (see wait_for_updates)
+        self.updates = []
+        self.condition = threading.Condition()
+
+    def get_status(self):
+        if not self.future.done():
+            return JOB_PENDING
+        if self.future.exception() is not None:
+            return JOB_FAILED
+        return JOB_DONE
+
+    def add_update(self, update):
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    # waits up to timeout seconds for updates past the first start ones.
+    # returns (the new updates, whether the job is done), where the job
+    # being done means there won't be any more
+    def wait_for_updates(self, start, timeout=None):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.updates) > start or self.future.done(),
+                timeout)
+            return self.updates[start:], self.future.done()
+
+# runs queries in the background so that a request only has to enqueue one
+# and hand back a job id. jobs only live in the memory of the process that
+# created them, so whatever serves the status polls needs to be the same
+# process (i.e. one gunicorn worker, with threads)
+class JobQueue():
+
+    def __init__(self,
+                 function,
+                 max_workers=DEFAULT_JOB_WORKERS,
+                 max_finished_jobs=DEFAULT_MAX_FINISHED_JOBS,
+                 finished_job_ttl=DEFAULT_FINISHED_JOB_TTL):
+        self.function = function
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_finished_jobs = max_finished_jobs
+        self.finished_job_ttl = finished_job_ttl
+
+        self.jobs = OrderedDict()
+        # normalized entity -> job that is still running for it
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    # function gets called with the entity, trace (a metrics.Trace or None)
+    # and progress, a function to hand updates on the query to
+    def submit(self, target_entity, trace=None):
+        entity = normalize_entity(target_entity)
+        with self.lock:
+            # somebody else already asked for this, so just wait on theirs
+            # (and get their trace, if they asked for one)
+            job = self.in_flight.get(entity)
+            if job is not None:
+                return job
+
+            self.evict_finished_jobs()
+
+            job = Job(uuid.uuid4().hex, target_entity, trace=trace)
+            job.future = self.executor.submit(self.function,
+                                              target_entity,
+                                              trace=trace,
+                                              progress=job.add_update)
+            self.jobs[job.job_id] = job
+            self.in_flight[entity] = job
+
+        job.future.add_done_callback(
+            lambda future: self.finish_job(entity, job))
+        return job
+
+    def finish_job(self, entity, job):
+        with self.lock:
+            if self.in_flight.get(entity) is job:
+                del self.in_flight[entity]
+
+        # wakes up anything waiting on the job's updates
+        job.finish()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def evict_finished_jobs(self):
+        # jobs are ordered by creation, so the oldest come first
+        finished_job_ids = [job_id for job_id, job in self.jobs.items() if \
+                            job.future.done()]
+        expired = time.time() - self.finished_job_ttl
+        extra_jobs = len(finished_job_ids) - self.max_finished_jobs
+        for job_id in finished_job_ids:
+            if extra_jobs <= 0 and self.jobs[job_id].created >= expired:
+                break
+
+            del self.jobs[job_id]
+            extra_jobs -= 1
@@ -2,16 +2,193 @@
 # Author: Antony Toron
 
 from sintmint import *
+from store import SentimentStore
+from annotation_cache import AnnotationCache
+from page_cache import PageCache
+import argparse
+import json
+import logging
+import os
 import traceback
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Score the general sentiment about entities online.")
+    parser.add_argument("--input",
+                        help="score every entity in this file (one per line, "
+                             "either plain text or JSONL) instead of asking "
+                             "for one")
+    parser.add_argument("--output",
+                        help="JSONL file to write batch results to. entities "
+                             "already in it are skipped, so an interrupted "
+                             "run can just be started again. entities that "
+                             "failed (including ones without a single usable "
+                             "page) are left out, and get retried")
+    parser.add_argument("--batch-workers",
+                        type=int,
+                        default=DEFAULT_BATCH_WORKERS,
+                        help="how many entities to work on at once")
+    parser.add_argument("--trace",
+                        action="store_true",
+                        help="include a breakdown of where each query's "
+                             "time went in the output")
+    parser.add_argument("--tier",
+                        choices=ANALYSIS_TIERS,
+                        default=DEFAULT_ANALYSIS_TIER,
+                        help="how much to ask the language API for: fast "
+                             "is sentiment only, full is everything, and "
+                             "adaptive only classifies the longest pages")
+    parser.add_argument("--hedged",
+                        action="store_true",
+                        help="use whichever usable pages come back first "
+                             "instead of the first ones in the search "
+                             "results, which keeps one slow site from "
+                             "holding up a query")
+    parser.add_argument("--pack",
+                        action="store_true",
+                        help="send small pages to the language API several "
+                             "at a time, which takes fewer requests")
+    parser.add_argument("--replay",
+                        help="answer from a fixture set (see bench/record.py) "
+                             "instead of going online. this doesn't need "
+                             "credentials, and doesn't touch the store or "
+                             "the caches")
+    args = parser.parse_args()
+
+    if args.input is not None and args.output is None:
+        parser.error("--output is required with --input")
+
+    return args
+
+def read_entities(path):
+    # lines can either be plain text, a JSON string, or a JSON object with an
+    # "entity" field
+    with open(path) as input_file:
+        for line in input_file:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                entity = json.loads(line)
+            except ValueError:
+                entity = line
+
+            if isinstance(entity, dict):
+                entity = entity.get("entity")
+            if not isinstance(entity, str) or not entity.strip():
+                continue
+
+            yield entity
+
+def read_finished_entities(path):
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+
+    with open(path) as output_file:
+        for line in output_file:
+            # the last line might have been cut off if we crashed mid-write
+            try:
+                finished.add(json.loads(line)["entity"])
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    return finished
+
+def run_batch(sintmint, input_path, output_path, batch_workers,
+              trace=False):
+    finished = read_finished_entities(output_path)
+    seen = set(finished)
+    entities = [entity for entity in read_entities(input_path) if not \
+                (entity in seen or seen.add(entity))]
+    logging.info("Scoring %d entities (%d already done)",
+                 len(entities),
+                 len(finished))
+    traces = {} if trace else None
+
+    with open(output_path, "a+") as output_file:
+        # don't glue our first result onto a line that was cut off
+        if output_file.tell() > 0:
+            output_file.seek(output_file.tell() - 1)
+            if output_file.read(1) != "\n":
+                output_file.write("\n")
+
+        # only entities that were scored on at least one page come back from
+        # get_sentiment_scores (the rest fail with e.g. NoUsablePagesError),
+        # so anything missing from the output gets another go next time
+        num_scored = 0
+        for entity, sentiment_score, entity_category in \
+            sintmint.get_sentiment_scores(entities, batch_workers, traces):
+            result = {"entity": entity,
+                      "score": sentiment_score,
+                      "category": entity_category}
+            if traces is not None:
+                result["trace"] = traces.pop(entity).to_json()
+
+            output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+            num_scored += 1
+
+    if num_scored < len(entities):
+        logging.info("Failed to score %d entities, run again to retry them",
+                     len(entities) - num_scored)
+
+def make_replay_sintmint(fixtures_path, analysis_tier, pack_documents,
+                         hedged):
+    # only needed for replaying, and not shipped with the app
+    from bench.fixtures import FixtureSet
+    from bench.stub import ReplayServer, ReplayLanguageClient
+
+    fixtures = FixtureSet.load(fixtures_path)
+    server = ReplayServer(fixtures)
+    return SintMint(client=ReplayLanguageClient(fixtures),
+                    search_page=server.search_page,
+                    analysis_tier=analysis_tier,
+                    pack_documents=pack_documents,
+                    hedged=hedged)
+
 def main():
-    print("Starting")
+    args = parse_args()
 
-    sintmint = SintMint()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.info("Starting")
+
+    # answers that come out of the store (or pages whose annotations are
+    # all cached) don't need credentials either, since the language API
+    # client only gets made once something needs annotating
+    if args.replay is not None:
+        sintmint = make_replay_sintmint(args.replay,
+                                        args.tier,
+                                        args.pack,
+                                        args.hedged)
+    else:
+        sintmint = SintMint(store=SentimentStore(),
+                            annotation_cache=AnnotationCache(),
+                            page_cache=PageCache(),
+                            analysis_tier=args.tier,
+                            pack_documents=args.pack,
+                            hedged=args.hedged)
+
+    if args.input is not None:
+        run_batch(sintmint,
+                  args.input,
+                  args.output,
+                  args.batch_workers,
+                  args.trace)
+        return
 
     target_entity = input("Please enter a name or entity: ")
+    trace = Trace() if args.trace else None
     sentiment_score, entity_category = \
-        sintmint.get_sentiment_score(target_entity)
+        sintmint.get_sentiment_score(target_entity, trace=trace)
+
+    # the same whether it was just worked out or came out of the store
+    print("Sentiment score for {}: {}".format(target_entity, sentiment_score))
+    print("Most likely category: {}".format(entity_category))
+
+    if trace is not None:
+        print(json.dumps(trace.to_json(), indent=2))
 
 def cleanup():
     pass
@@ -22,4 +199,3 @@ if __name__ == "__main__":
     except:
         traceback.print_exc()
         cleanup()
-
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from collections import defaultdict
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+# upper bounds (in seconds) of the latency histogram buckets
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                         5.0, 10.0)
+
+# the language API bills each annotate_text feature separately, per unit of
+# up to 1000 characters of each document. these are the list prices per unit
+# from https://cloud.google.com/natural-language/pricing (ignoring the free
+# units every month)
+LANGUAGE_UNIT_CHARACTERS = 1000
+LANGUAGE_UNIT_PRICES = {
+    "extract_entities": 0.001,
+    "extract_document_sentiment": 0.001,
+    "extract_entity_sentiment": 0.002,
+    "classify_text": 0.002,
+    "extract_syntax": 0.0005,
+}
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+# everything that happened while answering a single query, for when we want
+# to see where its time went
+class Trace():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, event, **info):
+        info["event"] = event
+        info["at"] = round(time.perf_counter() - self.start, 6)
+        with self.lock:
+            self.events.append(info)
+
+    def to_json(self):
+        with self.lock:
+            return list(self.events)
+
+class StageTimer():
+    def __init__(self):
+        # set by whoever is being timed, if the stage deals in bytes
+        self.num_bytes = None
+
+# process wide counters for each stage of a query, exposed in the prometheus
+# text format
+class Metrics():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = defaultdict(
+            lambda: Histogram(STAGE_SECONDS_BUCKETS))
+        self.stage_bytes = defaultdict(int)
+        # reason -> count
+        self.skipped_pages = defaultdict(int)
+        # (cache, "hit" or "miss") -> count
+        self.cache_requests = defaultdict(int)
+        # phase -> seconds, for the one off work of starting up
+        self.startup_seconds = {}
+        # analysis tier -> whole queries that weren't answered from the store
+        self.query_seconds = defaultdict(
+            lambda: Histogram(STAGE_SECONDS_BUCKETS))
+        # (analysis tier, feature) -> language API units
+        self.language_units = defaultdict(int)
+        # "refreshed" or "failed" -> background refreshes of popular entities
+        self.refreshes = defaultdict(int)
+
+    def observe_stage(self, stage, seconds, num_bytes=None, trace=None,
+                      **info):
+        with self.lock:
+            self.stage_seconds[stage].observe(seconds)
+            if num_bytes is not None:
+                self.stage_bytes[stage] += num_bytes
+
+        if trace is not None:
+            if num_bytes is not None:
+                info["bytes"] = num_bytes
+            trace.add(stage, seconds=round(seconds, 6), **info)
+
+    @contextmanager
+    def time_stage(self, stage, trace=None, **info):
+        timer = StageTimer()
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            self.observe_stage(stage,
+                               time.perf_counter() - start,
+                               timer.num_bytes,
+                               trace,
+                               **info)
+
+    def record_skip(self, reason, trace=None, **info):
+        with self.lock:
+            self.skipped_pages[reason] += 1
+
+        if trace is not None:
+            trace.add("skip", reason=reason, **info)
+
+    def record_cache(self, cache, hit, trace=None):
+        result = "hit" if hit else "miss"
+        with self.lock:
+            self.cache_requests[(cache, result)] += 1
+
+        if trace is not None:
+            trace.add("cache", cache=cache, result=result)
+
+    def observe_query(self, tier, seconds, trace=None):
+        with self.lock:
+            self.query_seconds[tier].observe(seconds)
+
+        if trace is not None:
+            trace.add("query", tier=tier, seconds=round(seconds, 6))
+
+    def record_language_units(self, tier, features, num_characters):
+        units = max(1, math.ceil(num_characters / LANGUAGE_UNIT_CHARACTERS))
+        with self.lock:
+            for feature, enabled in features.items():
+                if enabled:
+                    self.language_units[(tier, feature)] += units
+
+    # returns {analysis tier: estimated dollars}
+    def get_language_costs(self):
+        costs = defaultdict(float)
+        with self.lock:
+            for (tier, feature), units in self.language_units.items():
+                costs[tier] += units * LANGUAGE_UNIT_PRICES.get(feature, 0)
+
+        return dict(costs)
+
+    def record_refresh(self, result):
+        with self.lock:
+            self.refreshes[result] += 1
+
+    def record_startup(self, phase, seconds):
+        with self.lock:
+            self.startup_seconds[phase] = seconds
+
+    def render_histogram(self, lines, name, label, value, histogram):
+        for bucket, count in zip(histogram.buckets, histogram.counts):
+            lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                name, label, value, bucket, count))
+        lines.append('{}_bucket{{{}="{}",le="+Inf"}} {}'.format(
+            name, label, value, histogram.count))
+        lines.append('{}_sum{{{}="{}"}} {}'.format(
+            name, label, value, histogram.sum))
+        lines.append('{}_count{{{}="{}"}} {}'.format(
+            name, label, value, histogram.count))
+
+    def render(self):
+        costs = self.get_language_costs()
+
+        lines = []
+        with self.lock:
+            lines.append("# HELP sintmint_stage_seconds Time spent in each "
+                         "stage of a query.")
+            lines.append("# TYPE sintmint_stage_seconds histogram")
+            for stage, histogram in sorted(self.stage_seconds.items()):
+                self.render_histogram(lines,
+                                      "sintmint_stage_seconds",
+                                      "stage",
+                                      stage,
+                                      histogram)
+
+            lines.append("# HELP sintmint_query_seconds Time spent on whole "
+                         "queries, by analysis tier.")
+            lines.append("# TYPE sintmint_query_seconds histogram")
+            for tier, histogram in sorted(self.query_seconds.items()):
+                self.render_histogram(lines,
+                                      "sintmint_query_seconds",
+                                      "tier",
+                                      tier,
+                                      histogram)
+
+            lines.append("# HELP sintmint_language_units_total Language API "
+                         "units used, by analysis tier and feature.")
+            lines.append("# TYPE sintmint_language_units_total counter")
+            for (tier, feature), units in sorted(
+                    self.language_units.items()):
+                lines.append(
+                    'sintmint_language_units_total{{tier="{}",feature="{}"}} '
+                    '{}'.format(tier, feature, units))
+
+            lines.append("# HELP sintmint_language_cost_dollars_total "
+                         "Estimated language API cost, by analysis tier.")
+            lines.append("# TYPE sintmint_language_cost_dollars_total counter")
+            for tier, cost in sorted(costs.items()):
+                lines.append(
+                    'sintmint_language_cost_dollars_total{{tier="{}"}} '
+                    '{}'.format(tier, cost))
+
+            lines.append("# HELP sintmint_stage_bytes_total Bytes handled by "
+                         "each stage of a query.")
+            lines.append("# TYPE sintmint_stage_bytes_total counter")
+            for stage, num_bytes in sorted(self.stage_bytes.items()):
+                lines.append('sintmint_stage_bytes_total{{stage="{}"}} '
+                             '{}'.format(stage, num_bytes))
+
+            lines.append("# HELP sintmint_skipped_pages_total Result pages "
+                         "we couldn't use, by reason.")
+            lines.append("# TYPE sintmint_skipped_pages_total counter")
+            for reason, count in sorted(self.skipped_pages.items()):
+                lines.append('sintmint_skipped_pages_total{{reason="{}"}} '
+                             '{}'.format(reason, count))
+
+            lines.append("# HELP sintmint_cache_requests_total Cache "
+                         "lookups, by cache and result.")
+            lines.append("# TYPE sintmint_cache_requests_total counter")
+            for (cache, result), count in sorted(
+                    self.cache_requests.items()):
+                lines.append(
+                    'sintmint_cache_requests_total{{cache="{}",result="{}"}} '
+                    '{}'.format(cache, result, count))
+
+            lines.append("# HELP sintmint_refreshes_total Background "
+                         "refreshes of popular entities, by result.")
+            lines.append("# TYPE sintmint_refreshes_total counter")
+            for result, count in sorted(self.refreshes.items()):
+                lines.append('sintmint_refreshes_total{{result="{}"}} '
+                             '{}'.format(result, count))
+
+            lines.append("# HELP sintmint_startup_seconds Time spent on each "
+                         "phase of starting up.")
+            lines.append("# TYPE sintmint_startup_seconds gauge")
+            for phase, seconds in sorted(self.startup_seconds.items()):
+                lines.append('sintmint_startup_seconds{{phase="{}"}} '
+                             '{}'.format(phase, seconds))
+
+        return "\n".join(lines) + "\n"
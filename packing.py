@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# packs small documents (from any query) into one annotate_text request, and
+# splits the response back up into one response per document by the
+# begin_offsets of its sentences and mentions. offsets have to be in unicode
+# code points (EncodingType.UTF32) to line up with python string indices
+
+from concurrent.futures import Future
+from helpers import *
+import threading
+
+# far enough apart that google never runs a sentence from one document into
+# the next
+PACK_SEPARATOR = "\n\n\n"
+
+# how long the first document of a pack waits for others to join it
+DEFAULT_PACK_LINGER = 0.05
+
+# (start, end) offsets of each document in content packed from them
+def get_document_offsets(documents):
+    offsets = []
+    start = 0
+    for document in documents:
+        offsets.append((start, start + len(document)))
+        start += len(document) + len(PACK_SEPARATOR)
+
+    return offsets
+
+# anything in the separator after a document goes with the next one
+def get_document_index(offsets, offset):
+    for i, (start, end) in enumerate(offsets):
+        if offset < end:
+            return i
+
+    return len(offsets) - 1
+
+# google's document sentiment is roughly the sentences' averaged together,
+# and its magnitude is roughly theirs added up
+def set_combined_sentiment(sentiment, parts):
+    scores = [part.score for part in parts]
+    magnitudes = [part.magnitude for part in parts]
+    sentiment.score = sum(scores) / len(scores) if scores else 0.0
+    sentiment.magnitude = sum(magnitudes)
+
+# same, but weighted by magnitude, the way entity sentiment goes off of its
+# mentions
+def set_weighted_sentiment(sentiment, parts):
+    magnitudes = [part.magnitude for part in parts]
+    sentiment.score = get_weighted_average([part.score for part in parts],
+                                           magnitudes)
+    sentiment.magnitude = sum(magnitudes)
+
+# returns a response (the raw protobuf) for each document. categories are for
+# the pack as a whole, so nobody gets them
+def split_response(response, offsets):
+    if hasattr(type(response), "pb"):
+        response = type(response).pb(response)
+
+    responses = [type(response)() for start, end in offsets]
+    for document_response in responses:
+        document_response.language = response.language
+
+    for sentence in response.sentences:
+        i = get_document_index(offsets, sentence.text.begin_offset)
+        document_sentence = responses[i].sentences.add()
+        document_sentence.CopyFrom(sentence)
+        document_sentence.text.begin_offset -= offsets[i][0]
+
+    for document_response in responses:
+        set_combined_sentiment(
+            document_response.document_sentiment,
+            [sentence.sentiment for sentence in document_response.sentences])
+
+    # entity -> mentions in each document
+    for entity in response.entities:
+        document_mentions = [[] for start, end in offsets]
+        for mention in entity.mentions:
+            i = get_document_index(offsets, mention.text.begin_offset)
+            document_mentions[i].append(mention)
+
+        for i, mentions in enumerate(document_mentions):
+            if len(mentions) == 0:
+                continue
+
+            document_entity = responses[i].entities.add()
+            document_entity.name = entity.name
+            document_entity.type_ = entity.type_
+            document_entity.metadata.update(entity.metadata)
+            # how important the entity is to the pack, times how much of it
+            # is in this document. normalized once every entity is in
+            document_entity.salience = \
+                entity.salience * len(mentions) / len(entity.mentions)
+
+            for mention in mentions:
+                document_mention = document_entity.mentions.add()
+                document_mention.CopyFrom(mention)
+                document_mention.text.begin_offset -= offsets[i][0]
+
+            # entities google didn't give a score to get scored off of their
+            # mentions, so they have to stay without one
+            if len(mentions) == len(entity.mentions) or \
+               equal_with_tolerance(entity.sentiment.score, 0):
+                document_entity.sentiment.CopyFrom(entity.sentiment)
+            else:
+                set_weighted_sentiment(
+                    document_entity.sentiment,
+                    [mention.sentiment for mention in mentions])
+
+    # salience adds up to 1 within a document, and the scoring relies on the
+    # entities coming most salient first
+    for document_response in responses:
+        entities = sorted(document_response.entities,
+                          key=lambda entity: entity.salience,
+                          reverse=True)
+        total_salience = sum(entity.salience for entity in entities)
+        sorted_entities = [type(entity)() for entity in entities]
+        for sorted_entity, entity in zip(sorted_entities, entities):
+            sorted_entity.CopyFrom(entity)
+            if total_salience > 0:
+                sorted_entity.salience = entity.salience / total_salience
+
+        del document_response.entities[:]
+        document_response.entities.extend(sorted_entities)
+
+    return responses
+
+# collects documents from any thread, and hands them to annotate in packs of
+# up to max_size. a pack goes as soon as the next document wouldn't fit, or
+# once its first document has waited linger seconds
+# annotate(documents) runs on the executor, and returns a result for each
+# document
+class DocumentPacker():
+
+    def __init__(self, annotate, executor, max_size,
+                 linger=DEFAULT_PACK_LINGER):
+        self.annotate = annotate
+        self.executor = executor
+        self.max_size = max_size
+        self.linger = linger
+        self.lock = threading.Lock()
+
+        # [(document, trace, future)]
+        self.pending = []
+        self.pending_size = 0
+        self.timer = None
+
+    def get_packed_size(self, document):
+        if len(self.pending) == 0:
+            return len(document)
+        return self.pending_size + len(PACK_SEPARATOR) + len(document)
+
+    def submit(self, document, trace=None):
+        future = Future()
+        full_pack = None
+        with self.lock:
+            if self.pending and self.get_packed_size(document) > self.max_size:
+                full_pack = self.take_pending()
+
+            self.pending_size = self.get_packed_size(document)
+            self.pending.append((document, trace, future))
+
+            if self.timer is None:
+                self.timer = threading.Timer(self.linger, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full_pack is not None:
+            self.start_pack(full_pack)
+
+        return future
+
+    def flush(self):
+        with self.lock:
+            pack = self.take_pending()
+
+        if pack:
+            self.start_pack(pack)
+
+    def take_pending(self):
+        pack = self.pending
+        self.pending = []
+        self.pending_size = 0
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        return pack
+
+    def start_pack(self, pack):
+        self.executor.submit(self.run_pack, pack)
+
+    def run_pack(self, pack):
+        try:
+            results = self.annotate([(document, trace) for \
+                                     document, trace, future in pack])
+        except Exception as err:
+            for document, trace, future in pack:
+                future.set_exception(err)
+            return
+
+        for (document, trace, future), result in zip(pack, results):
+            future.set_result(result)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from annotation_cache import AnnotationCache
+import hashlib
+import json
+import os
+import time
+
+DEFAULT_PAGE_CACHE_DIR = os.environ.get("SINTMINT_PAGE_CACHE_DIR",
+                                        "page_cache")
+
+DEFAULT_MEMORY_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_DISK_CACHE_BYTES = 256 * 1024 * 1024
+
+# result pages are used as is for this long, and after that only once the
+# site tells us (with a conditional GET) that they haven't changed. pages
+# without an ETag or Last-Modified can't be checked, so they just expire
+DEFAULT_PAGE_SECONDS = 60 * 60
+DEFAULT_MAX_PAGE_AGE = 7 * 24 * 60 * 60
+
+# links we couldn't use (e.g. PDFs, 404s, pages that are too big) aren't
+# worth trying again for a while
+DEFAULT_SKIPPED_SECONDS = 24 * 60 * 60
+
+# search results change a lot more often than the pages they link to
+DEFAULT_SEARCH_SECONDS = 10 * 60
+
+PAGE_ENTRY = "page"
+SKIPPED_ENTRY = "skipped"
+SEARCH_ENTRY = "search"
+
+# caches the cleaned contents of result pages (and the search pages that link
+# to them) keyed by url, along with what we need to revalidate them. the
+# entries are small JSON documents kept in the same memory and disk layers as
+# the annotation cache
+class PageCache(AnnotationCache):
+
+    file_suffix = ".json"
+
+    def __init__(self,
+                 directory=DEFAULT_PAGE_CACHE_DIR,
+                 memory_bytes=DEFAULT_MEMORY_CACHE_BYTES,
+                 disk_bytes=DEFAULT_DISK_CACHE_BYTES,
+                 page_seconds=DEFAULT_PAGE_SECONDS,
+                 max_page_age=DEFAULT_MAX_PAGE_AGE,
+                 skipped_seconds=DEFAULT_SKIPPED_SECONDS,
+                 search_seconds=DEFAULT_SEARCH_SECONDS):
+        AnnotationCache.__init__(self, directory, memory_bytes, disk_bytes)
+        self.page_seconds = page_seconds
+        self.max_page_age = max_page_age
+        self.skipped_seconds = skipped_seconds
+        self.search_seconds = search_seconds
+
+    # the same url cleans up differently depending on the document type, and
+    # search pages are kept apart from everything else
+    def get_key(self, url, namespace):
+        digest = hashlib.sha256()
+        digest.update(namespace.encode())
+        digest.update(b"\0")
+        digest.update(url.encode(errors="replace"))
+        return digest.hexdigest()
+
+    def get_age(self, entry):
+        return time.time() - entry["stored_at"]
+
+    def is_fresh(self, entry):
+        if entry["kind"] == PAGE_ENTRY:
+            return self.get_age(entry) < self.page_seconds
+        if entry["kind"] == SKIPPED_ENTRY:
+            return self.get_age(entry) < self.skipped_seconds
+        return self.get_age(entry) < self.search_seconds
+
+    def can_revalidate(self, entry):
+        return entry["kind"] == PAGE_ENTRY and \
+            self.get_age(entry) < self.max_page_age and \
+            bool(entry["etag"] or entry["last_modified"])
+
+    # returns the entry if it can be used as is (see is_fresh) or
+    # revalidated, otherwise None
+    def get_entry(self, url, namespace):
+        data = self.get(self.get_key(url, namespace))
+        if data is None:
+            return None
+
+        try:
+            entry = json.loads(data)
+        except ValueError:
+            # e.g. written by a version that stored something else
+            return None
+
+        if not self.is_fresh(entry) and not self.can_revalidate(entry):
+            return None
+
+        return entry
+
+    def put_entry(self, url, namespace, entry):
+        entry["url"] = url
+        entry["stored_at"] = time.time()
+        self.put(self.get_key(url, namespace), json.dumps(entry).encode())
+
+    def put_page(self, url, namespace, contents, etag=None,
+                 last_modified=None):
+        self.put_entry(url,
+                       namespace,
+                       {"kind": PAGE_ENTRY,
+                        "contents": contents,
+                        "etag": etag,
+                        "last_modified": last_modified})
+
+    def put_skipped(self, url, namespace, skip_reason):
+        self.put_entry(url,
+                       namespace,
+                       {"kind": SKIPPED_ENTRY, "skip_reason": skip_reason})
+
+    def put_search(self, url, contents):
+        self.put_entry(url,
+                       SEARCH_ENTRY,
+                       {"kind": SEARCH_ENTRY, "contents": contents})
+
+    # for a page the site told us hasn't changed
+    def refresh(self, entry, namespace):
+        self.put_entry(entry["url"], namespace, entry)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from cachetools import LRUCache
+from email.utils import parsedate_to_datetime
+import datetime
+import random
+import threading
+import time
+
+# statuses that mean "try again later" rather than "this isn't going to work"
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+DEFAULT_MAX_RETRIES = 3
+
+# full jitter exponential backoff, see
+# https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+# when an upstream tells us to slow down we halve our rate, and then creep
+# back up a little on every success until we hit the configured rate again
+RATE_DECREASE_RATIO = 0.5
+RATE_INCREASE_RATIO = 0.05
+MIN_RATE_RATIO = 1.0 / 16
+
+# how many hosts we keep separate buckets for
+DEFAULT_MAX_BUCKETS = 10000
+
+def get_backoff(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+def parse_retry_after(value):
+    # Retry-After can either be a number of seconds or an http date
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity, max_throttle_wait=None):
+        # rate is in tokens per second, and is what we fall back towards
+        # after being throttled
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        # the longest a Retry-After can hold everybody back for, for
+        # upstreams we'd rather give up on than wait out
+        self.max_throttle_wait = max_throttle_wait
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        # updated can be in the future if we've been told to back off
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # blocks until there's a token available, and returns True once it's
+    # taken. returns False instead if there won't be one before deadline (in
+    # time.monotonic() terms), or if cancelled (an Event) gets set while
+    # waiting
+    def acquire(self, deadline=None, cancelled=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.updated and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                wait = max(self.updated - now,
+                           (1 - self.tokens) / self.rate)
+
+            if deadline is not None and now + wait > deadline:
+                return False
+
+            if cancelled is None:
+                time.sleep(wait)
+            elif cancelled.wait(wait):
+                return False
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * RATE_INCREASE_RATIO)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.rate = max(self.max_rate * MIN_RATE_RATIO,
+                            self.rate * RATE_DECREASE_RATIO)
+
+            # nobody gets to go until the upstream said we could, and then
+            # only one request at a time at the reduced rate
+            if retry_after is not None:
+                if self.max_throttle_wait is not None:
+                    retry_after = min(retry_after, self.max_throttle_wait)
+                self.tokens = 1
+                self.updated = max(self.updated, now + retry_after)
+            else:
+                self.tokens = 0
+
+# a separate token bucket for each key (e.g. each host), made as needed
+class RateLimiter():
+
+    def __init__(self, rate, capacity, max_buckets=DEFAULT_MAX_BUCKETS,
+                 max_throttle_wait=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_throttle_wait = max_throttle_wait
+        self.buckets = LRUCache(maxsize=max_buckets)
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate,
+                                     self.capacity,
+                                     self.max_throttle_wait)
+                self.buckets[key] = bucket
+
+        return bucket
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from ratelimit import TokenBucket
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# how often we look for popular entities to refresh
+DEFAULT_REFRESH_INTERVAL = 10 * 60
+
+# results get refreshed once they're this close to expiring from the store,
+# which leaves plenty of passes to get to them before they actually do
+DEFAULT_REFRESH_AHEAD = 24 * 60 * 60
+
+# the most entities we re-score an hour. each one costs about a search and
+# NUM_LINKS_TO_CHECK pages worth of language API calls
+DEFAULT_REFRESH_BUDGET = 60
+
+# only entities that have been asked for a few times recently (see
+# SentimentStore.record_query) are worth paying to keep fresh
+DEFAULT_MIN_POPULARITY = 2.0
+
+# re-scores the most popular entities in the store in the background before
+# their results expire, so that the people asking for them keep getting
+# stored results rather than waiting on a whole query
+class RefreshScheduler():
+
+    def __init__(self,
+                 sintmint,
+                 store,
+                 budget=DEFAULT_REFRESH_BUDGET,
+                 interval=DEFAULT_REFRESH_INTERVAL,
+                 refresh_ahead=DEFAULT_REFRESH_AHEAD,
+                 min_popularity=DEFAULT_MIN_POPULARITY):
+        self.sintmint = sintmint
+        self.store = store
+        self.budget = budget
+        self.interval = interval
+        self.refresh_ahead = refresh_ahead
+        self.min_popularity = min_popularity
+
+        # a whole hour's worth can go at once, e.g. when first starting up
+        self.bucket = TokenBucket(budget / (60 * 60), max(1, budget))
+
+        # the process the thread was started in, since threads don't make it
+        # across a fork (e.g. gunicorn --preload)
+        self.thread_pid = None
+        self.lock = threading.Lock()
+
+    # safe to call on every request, only the first one in each process
+    # starts anything
+    def start(self):
+        if self.budget <= 0:
+            return
+
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.thread_pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh_popular_entities()
+            except Exception:
+                # e.g. the store being locked for too long. there's always
+                # the next pass
+                logger.exception("Failed to refresh popular entities")
+
+            time.sleep(self.interval)
+
+    def refresh_popular_entities(self):
+        target_entities = self.store.get_stale_popular_entities(
+            self.budget,
+            self.refresh_ahead,
+            self.min_popularity)
+
+        for target_entity in target_entities:
+            self.bucket.acquire()
+            logger.info("Refreshing %s", target_entity)
+            try:
+                self.sintmint.get_sentiment_score(target_entity, refresh=True)
+            except Exception as err:
+                logger.warning("Failed to refresh %s: %r", target_entity, err)
+                self.sintmint.metrics.record_refresh("failed")
+                continue
+
+            self.sintmint.metrics.record_refresh("refreshed")
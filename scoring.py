@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+# array versions of the scoring in SintMint. the values we need from a google
+# response are pulled out once into numpy arrays, so rescoring the same
+# response (e.g. a cached page) against another entity is just a handful of
+# array operations
+
+import numpy as np
+from helpers import *
+
+# these seem to get sorted by salience roughly, so we can stop when we start
+# hitting really low salience numbers
+LOW_SALIENCE = 0.001
+
+# same tolerance as equal_with_tolerance
+ZERO_TOLERANCE = 0.00001
+
+def is_zero(values):
+    return np.abs(values) <= ZERO_TOLERANCE
+
+# the target entity split up into words once per query, rather than once
+# per mention
+class TargetEntity():
+    def __init__(self, name):
+        self.name = name
+        self.words = name.split(" ")
+
+    # gives a higher weight for how many words in the target entity appear in
+    # each of the texts
+    def get_mention_weights(self, texts):
+        words_appeared = np.array(
+            [sum(word in text for word in self.words) for text in texts],
+            dtype=float)
+
+        return words_appeared / len(self.words)
+
+class AnnotationArrays():
+    def __init__(self, google_response):
+        # proto-plus wraps every field access, which adds up over thousands
+        # of sentences and mentions, so read straight from the protobuf
+        if hasattr(type(google_response), "pb"):
+            google_response = type(google_response).pb(google_response)
+
+        entities = list(google_response.entities)
+
+        # only the entities before the first low salience one get counted
+        num_entities = len(entities)
+        for i, entity in enumerate(entities):
+            if entity.salience < LOW_SALIENCE:
+                num_entities = i
+                break
+        entities = entities[:num_entities]
+
+        self.entity_scores = np.array(
+            [entity.sentiment.score for entity in entities], dtype=float)
+        self.entity_magnitudes = np.array(
+            [entity.sentiment.magnitude for entity in entities], dtype=float)
+
+        # we only ever look at the mentions of entities google didn't give a
+        # score to, so those are the only ones we keep
+        mention_entities = []
+        mention_scores = []
+        mention_magnitudes = []
+        mention_texts = []
+        for i, entity in enumerate(entities):
+            if not equal_with_tolerance(entity.sentiment.score, 0):
+                continue
+
+            for mention in entity.mentions:
+                if equal_with_tolerance(mention.sentiment.score, 0):
+                    continue
+
+                mention_entities.append(i)
+                mention_scores.append(mention.sentiment.score)
+                mention_magnitudes.append(mention.sentiment.magnitude)
+                mention_texts.append(mention.text.content)
+
+        self.mention_entities = np.array(mention_entities, dtype=int)
+        self.mention_scores = np.array(mention_scores, dtype=float)
+        self.mention_magnitudes = np.array(mention_magnitudes, dtype=float)
+        # a numpy string array would make every text as wide as the longest
+        # one, so the texts stay a list
+        self.mention_texts = mention_texts
+
+        sentences = [sentence for sentence in google_response.sentences if \
+                     not equal_with_tolerance(sentence.sentiment.score, 0)]
+        self.sentence_scores = np.array(
+            [sentence.sentiment.score for sentence in sentences], dtype=float)
+        self.sentence_magnitudes = np.array(
+            [sentence.sentiment.magnitude for sentence in sentences],
+            dtype=float)
+        self.sentence_texts = [sentence.text.content for \
+                               sentence in sentences]
+
+        self.document_score = google_response.document_sentiment.score
+        self.document_magnitude = google_response.document_sentiment.magnitude
+
+        self.categories = []
+        for category in google_response.categories:
+            splits = category.name.split("/")
+            self.categories.append((splits[-1], category.confidence))
+
+    # returns (score, magnitude)
+    def get_entity_sentiment(self, target_entity):
+        scores = self.entity_scores.copy()
+
+        # sometimes, google can consider wrong words as part of the entity so
+        # we need to examine the mentions of the entities. for the entities
+        # without a score, use the weighted average of their mentions
+        if len(self.mention_scores) > 0:
+            mention_weights = target_entity.get_mention_weights(
+                self.mention_texts)
+            numerators = np.bincount(
+                self.mention_entities,
+                weights=self.mention_scores * mention_weights * \
+                    self.mention_magnitudes,
+                minlength=len(scores))
+            denominators = np.bincount(self.mention_entities,
+                                       weights=self.mention_magnitudes,
+                                       minlength=len(scores))
+            has_mentions = np.bincount(self.mention_entities,
+                                       minlength=len(scores)) > 0
+
+            valid = has_mentions & ~is_zero(denominators)
+            mention_averages = np.zeros(len(scores))
+            mention_averages[valid] = numerators[valid] / denominators[valid]
+        else:
+            mention_averages = np.zeros(len(scores))
+
+        unscored = is_zero(scores)
+        scores[unscored] = mention_averages[unscored]
+
+        return (get_weighted_average(scores, self.entity_magnitudes),
+                float(self.entity_magnitudes.sum()))
+
+    # returns (score, magnitude)
+    def get_sentence_sentiment(self, target_entity):
+        # we still want to count sentences in general, but give a bit more
+        # weight to those that actually include the target entity
+        mention_weights = target_entity.get_mention_weights(
+            self.sentence_texts) + 1
+        magnitudes = self.sentence_magnitudes * mention_weights
+
+        return (get_weighted_average(self.sentence_scores, magnitudes),
+                float(magnitudes.sum()))
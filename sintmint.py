@@ -3,61 +3,220 @@
 
 # most based on https://googleapis.dev/python/language/latest/usage.html
 
-from google.cloud import language_v1
-from google.oauth2 import service_account
+# google.cloud.language_v1 (along with grpc and the auth libraries under it)
+# and lxml.html.clean take a good while to import, and plenty of queries are
+# answered from the store without them, so they only get imported once
+# they're actually needed
 
-import urllib.parse, urllib.request
+import urllib.parse
 from urllib.error import HTTPError
-from html.parser import HTMLParser
 import time
 from helpers import *
-from lxml.html.clean import Cleaner
-from collections import defaultdict
+import lxml.etree
+import lxml.html
+import clean
+from fetcher import PageFetcher, get_header_charset
+from ratelimit import *
+from scoring import AnnotationArrays, TargetEntity
+from metrics import Metrics, Trace
+from packing import *
+from page_cache import PAGE_ENTRY, SEARCH_ENTRY
+import logging
+import urllib3
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+import numpy as np
+import codecs
+import re
 import os
+import sys
 import json
 
+logger = logging.getLogger(__name__)
+
 DEFAULT_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
                      "(KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36"
 DEFAULT_ACCEPT = "text/html,application/xhtml+xml,application/xml;q=0.9," \
                  "*/*;q=0.8"
 
-# tested empirically
+# where the links we follow come from
+GOOGLE_SEARCH_PAGE = "https://google.com/search?q={}"
+
+# tested empirically. pages bigger than SIZE_CAP get split up and annotated
+# in chunks
 MAX_GOOGLE_REQUEST_SIZE = 1000000
 SIZE_CAP = MAX_GOOGLE_REQUEST_SIZE - int(MAX_GOOGLE_REQUEST_SIZE / 10)
 
+# the most chunks of one page we pay to annotate. anything past that is
+# usually comments, references, etc. anyway
+MAX_PAGE_CHUNKS = 4
+
 # actually 20 via https://cloud.google.com/natural-language/docs/basics but
 # buffering a bit
 MIN_GOOGLE_REQUEST_SIZE = 100
 
-class BasicHTMLParser(HTMLParser):
-    def __init__(self):
-        HTMLParser.__init__(self)
-        self.links = []
-
-    def handle_starttag(self, tag, attrs):
-        # we only really care about links
-        if tag != 'a':
-            return
-
-        for attr, value in attrs:
-            if attr != 'href':
-                continue
-
-            # seems to come after most links that are not back to another
-            # google page within the webpage
-            STANDARD_LINK_PREFIX = "/url?q="
-            if not value.startswith(STANDARD_LINK_PREFIX):
-                continue
-
-            # sometimes there are ad-related links for google that we can skip
-            # (this might not always be a good heuristic)
-            # some really hacky heuristics for links we don't want to follow:
-            # - google ad-based links
-            if "google" in value:
-                continue
-
-            link = value[len(STANDARD_LINK_PREFIX):].split("&")[0]
-            self.links.append(link)
+# raw pages bigger than this are very unlikely to clean down to something
+# under MAX_PAGE_CHUNKS chunks, so we stop downloading them part way through
+MAX_PAGE_DOWNLOAD_SIZE = 5 * MAX_GOOGLE_REQUEST_SIZE
+PAGE_CHUNK_SIZE = 64 * 1024
+
+# pages that don't say what charset they are in the headers usually do in a
+# <meta> tag near the top, and browsers only look at the first 1024 bytes
+CHARSET_SNIFF_SIZE = 1024
+META_CHARSET_PATTERN = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)',
+    re.IGNORECASE)
+
+# what we send off to google for each page. plain text is just the main
+# content of the page, which is a lot smaller (and so cheaper and faster to
+# annotate) than the cleaned html with all of its navigation, footers, etc.
+DOCUMENT_TYPE_HTML = "html"
+DOCUMENT_TYPE_TEXT = "text"
+DEFAULT_DOCUMENT_TYPE = DOCUMENT_TYPE_TEXT
+
+# how much we ask the language API for. fast only gets the document and
+# sentence sentiment, full gets everything annotate_text has for every page,
+# and adaptive gets the entity sentiment for every page but only classifies
+# the longest few pages of each query (which is all the category needs)
+ANALYSIS_FAST = "fast"
+ANALYSIS_FULL = "full"
+ANALYSIS_ADAPTIVE = "adaptive"
+ANALYSIS_TIERS = (ANALYSIS_FAST, ANALYSIS_FULL, ANALYSIS_ADAPTIVE)
+DEFAULT_ANALYSIS_TIER = ANALYSIS_FULL
+ADAPTIVE_CLASSIFIED_PAGES = 2
+
+# google refuses to classify anything shorter than this
+MIN_CLASSIFY_WORDS = 20
+
+# with pack_documents, pages up to this size get packed together with other
+# small pages (of the same query or any other) into one annotate_text
+# request of up to SIZE_CAP. google can't classify the pages of a pack
+# separately, so packing classifies the longest few pages of each query on
+# their own, the way the adaptive tier does
+MAX_PACKED_DOCUMENT_SIZE = int(SIZE_CAP / 10)
+
+# reasons we end up not using a result page
+SKIP_HTTP_ERROR = "http_error"
+SKIP_NON_HTML = "non_html"
+SKIP_TOO_LARGE = "too_large"
+SKIP_TOO_SMALL = "too_small"
+SKIP_TIMEOUT = "timeout"
+SKIP_CANCELLED = "cancelled"
+# anything else going wrong with the page, e.g. a bug in cleaning it up
+SKIP_FAILED = "failed"
+
+# what download_page says instead of a skip reason when the page we have
+# cached is still good
+PAGE_NOT_MODIFIED = "not_modified"
+
+# skipped pages that would be skipped again next time, and so are worth
+# remembering in the page cache. timeouts, cancellations and failed
+# connections only say something about that one time
+CACHED_SKIP_REASONS = frozenset([SKIP_NON_HTML,
+                                 SKIP_TOO_LARGE,
+                                 SKIP_TOO_SMALL])
+# 4xx statuses that have more to do with us than with the page
+UNCACHED_CLIENT_ERRORS = frozenset([408, 429])
+
+# how many of the search result links we actually want to use per query
+NUM_LINKS_TO_CHECK = 3
+
+# how many result pages we download at once, and how many annotate_text calls
+# we allow to be in flight at once (the latter is what counts against the
+# language API quota, so it should stay fairly small)
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_ANNOTATE_WORKERS = 3
+
+# starting (and maximum) rates we go at for each upstream, in requests per
+# second. each one backs off on its own when it tells us to slow down
+GOOGLE_SEARCH_RATE = 1.0
+GOOGLE_SEARCH_BURST = 3
+# the longest a Retry-After from google holds every query's search back for.
+# past that, searches fail (see download_search_page) rather than leaving the
+# request threads asleep
+GOOGLE_SEARCH_MAX_THROTTLE_WAIT = 10.0
+RESULT_HOST_RATE = 2.0
+RESULT_HOST_BURST = 4
+# the language API's default quota is 600 requests per minute
+LANGUAGE_API_RATE = 10.0
+LANGUAGE_API_BURST = 10
+
+# result pages that need more than a short wait to retry aren't worth it,
+# since there are plenty of other results to use instead
+RESULT_PAGE_MAX_RETRIES = 1
+RESULT_PAGE_MAX_RETRY_WAIT = 2.0
+
+# in hedged mode, we start downloading this many links for every page we
+# still need, and use whichever usable pages come back first, so that one
+# slow site can't hold up the whole query
+HEDGED_FETCHES_PER_LINK = 2
+
+# how long a single page download gets, how long a hedged query spends
+# looking for usable pages, and how long an annotate_text call gets
+DEFAULT_LINK_TIMEOUT = 5.0
+DEFAULT_QUERY_TIMEOUT = 8.0
+DEFAULT_ANNOTATE_TIMEOUT = 10.0
+
+# how many entities get_sentiment_scores works on at once. the entities
+# mostly just wait on the shared fetch and annotate pools
+DEFAULT_BATCH_WORKERS = 8
+
+# processes cleaning pages, and how many pages each of them can have waiting
+# on it before the downloads have to wait for them to catch up. with no
+# processes, pages get cleaned on the thread that downloaded them
+DEFAULT_CLEAN_WORKERS = min(4, os.cpu_count() or 1)
+CLEAN_QUEUE_DEPTH_PER_WORKER = 2
+
+# seems to come before most links that are not back to another google page
+# within the webpage
+STANDARD_LINK_PREFIX = "/url?q="
+RESULT_LINKS_XPATH = lxml.etree.XPath(
+    '//a[starts-with(@href, "{}")]/@href'.format(STANDARD_LINK_PREFIX))
+
+# returns the links (in order, possibly repeated) of the results on a google
+# search page. lxml hands them over in one go, rather than a python callback
+# for every tag on the page
+def get_result_links(search_page):
+    try:
+        search_tree = clean.parse_page(search_page)
+    except lxml.etree.ParserError:
+        return []
+
+    links = []
+    for value in RESULT_LINKS_XPATH(search_tree):
+        # sometimes there are ad-related links for google that we can skip
+        # (this might not always be a good heuristic)
+        # some really hacky heuristics for links we don't want to follow:
+        # - google ad-based links
+        if "google" in value:
+            continue
+
+        links.append(value[len(STANDARD_LINK_PREFIX):].split("&")[0])
+
+    return links
+
+# why a page got skipped over a urllib3 error. the fetcher does its own
+# retrying, so urllib3 hands back connect and read timeouts wrapped up in a
+# MaxRetryError
+def get_error_skip_reason(err, cancelled=None):
+    if cancelled is not None and cancelled.is_set():
+        return SKIP_CANCELLED
+
+    if isinstance(err, urllib3.exceptions.MaxRetryError):
+        err = err.reason
+    if isinstance(err, urllib3.exceptions.TimeoutError):
+        return SKIP_TIMEOUT
+
+    return SKIP_HTTP_ERROR
+
+# none of the result pages for an entity could be used (e.g. they all timed
+# out or got skipped), so there's nothing to score it on
+class NoUsablePagesError(RuntimeError):
+    pass
 
 class TextInfo():
     def __init__(self, score, magnitude, categories, site, content_length):
@@ -89,66 +248,347 @@ class Sentiment():
             self.score,
             self.magnitude)
 
+# gevent workers (gunicorn -k gevent) swap out the standard library's
+# sockets, and grpc needs to be told before it makes any channels
+def is_gevent_patched():
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("socket")
+
+# pages shared between the entities of a get_sentiment_scores call, so that
+# each page is only downloaded and annotated once between the entities being
+# scored at the same time. a page gets dropped once none of them has it in
+# its search results, so that a long batch doesn't hold on to every page it
+# ever saw (the annotation cache takes care of pages that come up again)
+class PageBatch():
+    def __init__(self):
+        # link -> future of the cleaned page contents
+        self.fetches = {}
+        # link -> (content length, future of the google response)
+        self.annotations = {}
+        # link -> future of the page's categories, for adaptive analysis
+        self.classifications = {}
+        # link -> how many entities being scored have it in their results
+        self.holds = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def hold(self, links):
+        with self.lock:
+            for link in set(links):
+                self.holds[link] += 1
+
+    def release(self, links):
+        with self.lock:
+            for link in set(links):
+                self.holds[link] -= 1
+                if self.holds[link] > 0:
+                    continue
+
+                del self.holds[link]
+                fetch = self.fetches.pop(link, None)
+                if fetch is not None:
+                    # nobody is left to use it if it hasn't started yet
+                    fetch.cancel()
+                self.annotations.pop(link, None)
+                self.classifications.pop(link, None)
+
+# one SintMint is shared by every query in the process (e.g. every request
+# thread of the app), so nothing about a single query is kept on it. the
+# per-query state (PageBatch, Trace) gets made by each query, and everything
+# shared (client, pools, buckets, caches, metrics) is safe to use from many
+# threads at once
 class SintMint():
 
-    def __init__(self):
+    def __init__(self,
+                 fetch_workers=DEFAULT_FETCH_WORKERS,
+                 annotate_workers=DEFAULT_ANNOTATE_WORKERS,
+                 clean_workers=DEFAULT_CLEAN_WORKERS,
+                 store=None,
+                 annotation_cache=None,
+                 page_cache=None,
+                 document_type=DEFAULT_DOCUMENT_TYPE,
+                 fetcher=None,
+                 hedged=False,
+                 link_timeout=DEFAULT_LINK_TIMEOUT,
+                 query_timeout=DEFAULT_QUERY_TIMEOUT,
+                 annotate_timeout=DEFAULT_ANNOTATE_TIMEOUT,
+                 metrics=None,
+                 client=None,
+                 search_page=GOOGLE_SEARCH_PAGE,
+                 analysis_tier=DEFAULT_ANALYSIS_TIER,
+                 pack_documents=False,
+                 pack_linger=DEFAULT_PACK_LINGER):
+        # anything with annotate_text can stand in for the language API
+        # client, e.g. to replay recorded responses. otherwise, get_client
+        # makes one the first time we need it
+        self.client = client
+        # the process our own client was made in, since gRPC channels can't
+        # be used across a fork (e.g. gunicorn --preload)
+        self.client_pid = None
+        self.client_lock = threading.Lock()
+
+        # with a {} for the (quoted) search terms
+        self.search_page = search_page
+
+        # page downloads are mostly waiting on the network and the gRPC calls
+        # release the GIL, so threads are enough to overlap them
+        self.fetch_workers = fetch_workers
+        self.fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers)
+        self.annotate_pool = ThreadPoolExecutor(max_workers=annotate_workers)
+
+        # cleaning doesn't let go of the GIL, so it gets processes instead.
+        # the pool is made by get_clean_pool the first time a page needs
+        # cleaning (in each process, since it can't be used across a fork)
+        self.clean_workers = clean_workers
+        self.clean_pool = None
+        self.clean_pool_pid = None
+        self.clean_pool_lock = threading.Lock()
+        # pages waiting on or being cleaned. once these run out, downloads
+        # hold on to their pages until there's room
+        self.clean_slots = threading.BoundedSemaphore(
+            max(1, clean_workers * CLEAN_QUEUE_DEPTH_PER_WORKER))
+
+        # optional SentimentStore of previously computed results
+        self.store = store
+
+        # optional AnnotationCache of previous responses from google, keyed by
+        # the page content we sent
+        self.annotation_cache = annotation_cache
+
+        # optional PageCache of cleaned result pages, links we couldn't use
+        # and search pages
+        self.page_cache = page_cache
+
+        self.document_type = document_type
+
+        if analysis_tier not in ANALYSIS_TIERS:
+            raise ValueError("Unknown analysis tier {}".format(analysis_tier))
+        self.analysis_tier = analysis_tier
+
+        # the offsets in responses to html documents don't line up with
+        # what we sent, so there'd be no telling the pages of a pack apart
+        if pack_documents and document_type != DOCUMENT_TYPE_TEXT:
+            raise ValueError("Only plain text documents can be packed")
+        self.packer = None
+        if pack_documents:
+            self.packer = DocumentPacker(self.annotate_pack,
+                                         self.annotate_pool,
+                                         SIZE_CAP,
+                                         pack_linger)
+
+        # all of the search and page downloads go through here, so that they
+        # share keep-alive connections
+        if fetcher is None:
+            fetcher = PageFetcher(pool_size=fetch_workers)
+        self.fetcher = fetcher
+
+        # hedged mode takes the first usable pages to come back, rather than
+        # the first usable pages in the order of the search results
+        self.hedged = hedged
+        self.link_timeout = link_timeout
+        self.query_timeout = query_timeout
+        self.annotate_timeout = annotate_timeout
+
+        # shared by every query in the process, so that together they stay
+        # under what each upstream allows
+        self.search_bucket = TokenBucket(
+            GOOGLE_SEARCH_RATE,
+            GOOGLE_SEARCH_BURST,
+            max_throttle_wait=GOOGLE_SEARCH_MAX_THROTTLE_WAIT)
+        # a result host asking us to wait longer than we'd wait on a retry
+        # would otherwise hold up every query's fetches from it that long
+        self.host_limiter = RateLimiter(
+            RESULT_HOST_RATE,
+            RESULT_HOST_BURST,
+            max_throttle_wait=RESULT_PAGE_MAX_RETRY_WAIT)
+        self.language_bucket = TokenBucket(LANGUAGE_API_RATE,
+                                           LANGUAGE_API_BURST)
+
+        # normalized entity -> future of the result for each entity being
+        # scored right now
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+
+        # per stage timings, byte counts, skipped pages and cache hits
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+    def get_client(self):
+        with self.client_lock:
+            if self.client is None or \
+               (self.client_pid is not None and \
+                self.client_pid != os.getpid()):
+                start = time.perf_counter()
+                self.client = self.create_client()
+                self.client_pid = os.getpid()
+                self.metrics.record_startup("client",
+                                            time.perf_counter() - start)
+
+            return self.client
+
+    # the client itself is fine to share between threads
+    def create_client(self):
+        from google.cloud import language_v1
+        from google.oauth2 import service_account
+
+        if is_gevent_patched():
+            import grpc.experimental.gevent
+            grpc.experimental.gevent.init_gevent()
+
         # thanks to https://stackoverflow.com/questions/47446480
         json_str = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+        if not json_str:
+            raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS has to be set "
+                               "to annotate pages")
+
         json_data = json.loads(json_str)
         json_data["private_key"] = json_data["private_key"].replace('\\n', '\n')
         credentials = service_account.Credentials.from_service_account_info(
             json_data)
 
-        self.client = language_v1.LanguageServiceClient(credentials=credentials)
-        self.parser = BasicHTMLParser()
-
-        self.cleaner = Cleaner(page_structure=True,
-                               scripts=True,
-                               javascript=True,
-                               comments=True,
-                               style=True,
-                               inline_style=True,
-                               links=True,
-                               meta=True,
-                               processing_instructions=True,
-                               embedded=True,
-                               frames=True,
-                               forms=True,
-                               annoying_tags=True,
-                               safe_attrs_only=True,
-                               safe_attrs=frozenset())
+        return language_v1.LanguageServiceClient(credentials=credentials)
+
+    def get_clean_pool(self):
+        with self.clean_pool_lock:
+            if self.clean_pool is None or \
+               self.clean_pool_pid != os.getpid():
+                start = time.perf_counter()
+                # forking the workers off of a process full of threads could
+                # leave them with locks that will never be let go of
+                self.clean_pool = ProcessPoolExecutor(
+                    max_workers=self.clean_workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                    initializer=clean.init_worker)
+                self.clean_pool_pid = os.getpid()
+                self.metrics.record_startup("clean_pool",
+                                            time.perf_counter() - start)
+
+            return self.clean_pool
+
+    def reset_clean_pool(self, clean_pool):
+        with self.clean_pool_lock:
+            if self.clean_pool is clean_pool:
+                self.clean_pool = None
+
+    # also have analyze_entities, which provides proper names or entities
+    # in the text, like a person or place, along with a salience (how
+    # important it might be)
+    # magnitude is the overall score from (0, inf) for the whole document
+    # or sentence (each sentence also gets analyzed individually) so
+    # longer documents are bound to get higher magnitudes.
+    def get_features(self, page_contents):
+        entities = self.analysis_tier != ANALYSIS_FAST
+        classify = self.analysis_tier == ANALYSIS_FULL and \
+            self.packer is None and \
+            len(page_contents.split()) >= MIN_CLASSIFY_WORDS
+
+        return {
+            "extract_syntax": False,
+            "extract_entities": entities,
+            "extract_document_sentiment": True,
+            "extract_entity_sentiment": entities,
+            "classify_text": classify
+        }
 
     # internal, should really only be used on an actual piece of text and not
     # the input text from the user
-    def get_text_annotations(self, html_text):
+    # features default to what the analysis tier gets for every page
+    def get_text_annotations(self, page_contents, trace=None, features=None,
+                             stage="annotate", encoding_type=None):
+        from google.cloud import language_v1
+
         #return language_v1.types.AnnotateTextResponse()
 
+        if self.document_type == DOCUMENT_TYPE_TEXT:
+            document_type = language_v1.Document.Type.PLAIN_TEXT
+        else:
+            document_type = language_v1.Document.Type.HTML
+
         # language field left blank will make the API auto-detect the language
         document = language_v1.Document(
-            content=html_text,
-            type_=language_v1.Document.Type.HTML)
-
-        # also have analyze_entities, which provides proper names or entities
-        # in the text, like a person or place, along with a salience (how
-        # important it might be)
-        # magnitude is the overall score from (0, inf) for the whole document
-        # or sentence (each sentence also gets analyzed individually) so
-        # longer documents are bound to get higher magnitudes.
-        features = {
-            "extract_syntax": False,
-            "extract_entities": True,
-            "extract_document_sentiment": True,
-            "extract_entity_sentiment": True,
-            "classify_text": True
-        }
-
-        # TODO catch errors here
-        response = self.client.annotate_text(
-            document=document,
-            features=features)
+            content=page_contents,
+            type_=document_type)
+
+        if features is None:
+            features = self.get_features(page_contents)
+
+        # the same page often shows up for different entities, and the
+        # response doesn't depend on the entity, so we can reuse it
+        if self.annotation_cache is not None:
+            cache_key = self.annotation_cache.get_key(page_contents,
+                                                      self.document_type,
+                                                      features)
+            cached_response = self.annotation_cache.get(cache_key)
+            self.metrics.record_cache("annotation",
+                                      cached_response is not None,
+                                      trace)
+            if cached_response is not None:
+                return language_v1.AnnotateTextResponse.deserialize(
+                    cached_response)
+
+        with self.metrics.time_stage(stage, trace) as timer:
+            timer.num_bytes = len(page_contents.encode())
+            response = self.annotate_with_retries(document,
+                                                  features,
+                                                  encoding_type)
+        self.metrics.record_language_units(self.analysis_tier,
+                                           features,
+                                           len(page_contents))
+
+        if self.annotation_cache is not None:
+            self.annotation_cache.put(
+                cache_key,
+                language_v1.AnnotateTextResponse.serialize(response))
 
         return response
 
+    def get_retry_delay(self, err):
+        # google sometimes tells us how long to wait in the error details
+        for detail in getattr(err, "details", None) or []:
+            retry_delay = getattr(detail, "retry_delay", None)
+            if retry_delay is not None:
+                return retry_delay.seconds + retry_delay.nanos / 1e9
+
+        return None
+
+    def annotate_with_retries(self, document, features, encoding_type=None):
+        from google.api_core import exceptions as google_exceptions
+
+        client = self.get_client()
+        attempt = 0
+        while True:
+            self.language_bucket.acquire()
+            try:
+                # we do our own retrying, so that it goes through the bucket
+                response = client.annotate_text(
+                    document=document,
+                    features=features,
+                    encoding_type=encoding_type,
+                    retry=None,
+                    timeout=self.annotate_timeout)
+            except (google_exceptions.ResourceExhausted,
+                    google_exceptions.ServiceUnavailable) as err:
+                retry_delay = self.get_retry_delay(err)
+                throttled = \
+                    isinstance(err, google_exceptions.ResourceExhausted)
+                if throttled:
+                    self.language_bucket.on_throttle(retry_delay)
+
+                if attempt >= DEFAULT_MAX_RETRIES:
+                    raise
+
+                # a throttled bucket already holds us back until the retry
+                # delay has passed
+                if retry_delay is None:
+                    time.sleep(get_backoff(attempt))
+                elif not throttled:
+                    time.sleep(retry_delay)
+                attempt += 1
+                continue
+
+            self.language_bucket.on_success()
+            return response
+
     def normalize_magnitudes(self, magnitudes):
         if len(magnitudes) == 0:
             return magnitudes
@@ -156,99 +596,45 @@ class SintMint():
         # magnitudes can range from [0, inf), so we need to take the sum of the
         # magnitudes we find in the list and use that to bound our magnitudes
         # so we can get actual weights
-        total_magnitude = sum(magnitudes)
+        magnitudes = np.asarray(magnitudes, dtype=float)
+        total_magnitude = magnitudes.sum()
         if equal_with_tolerance(total_magnitude, 0.0):
             return magnitudes
 
-        magnitudes = [magnitude / total_magnitude for magnitude in magnitudes]
-        return magnitudes
+        return magnitudes / total_magnitude
 
-    def get_mention_weight(self, mention_text, target_entity):
-        # gives a higher score for how many words in the target entity
-        # appear in the mention text
-        words_appeared = 0
-        words = target_entity.split(" ")
-        for word in words:
-            if word in mention_text:
-                words_appeared += 1
+    # the scoring below works on arrays pulled out of the google response
+    # and a tokenized target entity, but takes the plain versions too
+    def get_annotation_arrays(self, google_response):
+        if isinstance(google_response, AnnotationArrays):
+            return google_response
+        return AnnotationArrays(google_response)
 
-        return float(words_appeared) / len(words)
+    def get_target_entity(self, target_entity):
+        if isinstance(target_entity, TargetEntity):
+            return target_entity
+        return TargetEntity(target_entity)
 
     def get_entity_sentiment(self, google_response, target_entity):
-        entity_scores = []
-        entity_magnitudes = []
-
-        for entity in google_response.entities:
-            # these seem to get sorted by salience roughly, so we can break
-            # when we start hitting really low salience numbers
-            LOW_SALIENCE = 0.001
-            if entity.salience < LOW_SALIENCE:
-                break
-
-            # sometimes, google can consider wrong words as part of the entity
-            # so we need to examine the mentions of the entities. usually, the
-            # entities at the top of the list of entities are important, so
-            # we should look at the mentions and see the overall sentiment there
-            score = entity.sentiment.score
-            magnitude = entity.sentiment.magnitude
-            if equal_with_tolerance(score, 0):
-                # we're going to need to look at the mentions to get a good
-                # idea of the sentiment
-                mention_scores = []
-                mention_magnitudes = []
-                for mention in entity.mentions:
-                    if equal_with_tolerance(mention.sentiment.score, 0):
-                        continue
-
-                    mention_weight = self.get_mention_weight(
-                        mention.text.content,
-                        target_entity)
+        score, magnitude = \
+            self.get_annotation_arrays(google_response).get_entity_sentiment(
+                self.get_target_entity(target_entity))
 
-                    mention_scores.append(
-                        mention.sentiment.score * mention_weight)
-                    mention_magnitudes.append(mention.sentiment.magnitude)
-
-                mention_weights = \
-                    self.normalize_magnitudes(mention_magnitudes)
-                score = get_weighted_average(mention_scores, mention_weights)
-
-            entity_scores.append(score)
-            entity_magnitudes.append(magnitude)
-
-        entity_weights = self.normalize_magnitudes(entity_magnitudes)
-        entity_score = get_weighted_average(entity_scores, entity_weights)
-
-        return Sentiment(entity_score, sum(entity_magnitudes), 'entity')
+        return Sentiment(score, magnitude, 'entity')
 
     def get_sentence_sentiment(self, google_response, target_entity):
-        sentence_scores = []
-        sentence_magnitudes = []
-        for sentence in google_response.sentences:
-            if equal_with_tolerance(sentence.sentiment.score, 0):
-                continue
-
-            mention_weight = self.get_mention_weight(sentence.text.content,
-                                                     target_entity)
+        score, magnitude = \
+            self.get_annotation_arrays(google_response).get_sentence_sentiment(
+                self.get_target_entity(target_entity))
 
-            # we still want to count sentences in general, but give a bit
-            # more weight to those that actually include the target entity
-            mention_weight += 1
-
-            sentence_scores.append(sentence.sentiment.score)
-            sentence_magnitudes.append(
-                sentence.sentiment.magnitude * mention_weight)
-        
-        sentence_weights = self.normalize_magnitudes(sentence_magnitudes)
-        sentence_score = get_weighted_average(sentence_scores,
-                                              sentence_weights)
-
-        return Sentiment(sentence_score, sum(sentence_magnitudes), 'sentence')
+        return Sentiment(score, magnitude, 'sentence')
 
     def analyze_text_annotations(self,
                                  google_response,
                                  target_entity,
                                  site,
-                                 content_length):
+                                 content_length,
+                                 trace=None):
         # we will determine the overall sentiment of the person/phrase as
         # follows:
         # - hopefully find the person as an entity in the list of entities
@@ -270,28 +656,44 @@ class SintMint():
         # results. maybe different combinations will give better scores for
         # different content types?
 
-        entity_sentiment = self.get_entity_sentiment(google_response,
+        with self.metrics.time_stage("score", trace, site=site):
+            return self.score_text_annotations(google_response,
+                                               target_entity,
+                                               site,
+                                               content_length)
+
+    def score_text_annotations(self,
+                               google_response,
+                               target_entity,
+                               site,
+                               content_length):
+        annotations = self.get_annotation_arrays(google_response)
+        target_entity = self.get_target_entity(target_entity)
+
+        entity_sentiment = self.get_entity_sentiment(annotations,
                                                      target_entity)
 
         document_sentiment = Sentiment(
-            google_response.document_sentiment.score,
-            google_response.document_sentiment.magnitude,
+            annotations.document_score,
+            annotations.document_magnitude,
             'document')
 
 
-        sentence_sentiment = self.get_sentence_sentiment(google_response,
+        sentence_sentiment = self.get_sentence_sentiment(annotations,
                                                          target_entity)
 
-        # combine results
+        # combine results. whatever google wasn't asked for (e.g. entities in
+        # the fast tier) comes back empty and just doesn't count
         all_sentiments = [
-            entity_sentiment,
             document_sentiment,
             sentence_sentiment
         ]
+        if len(annotations.entity_scores) > 0:
+            all_sentiments.insert(0, entity_sentiment)
         total_scores = []
         total_magnitudes = []
         for sentiment in all_sentiments:
-            print(sentiment)
+            logger.debug(sentiment)
 
             if equal_with_tolerance(sentiment.score, 0) or \
                equal_with_tolerance(sentiment.magnitude, 0):
@@ -303,34 +705,91 @@ class SintMint():
         total_weights = self.normalize_magnitudes(total_magnitudes)
         total_score = get_weighted_average(total_scores, total_weights)
 
-        categories = []
-        for category in google_response.categories:
-            splits = category.name.split("/")
-            categories.append((splits[-1], category.confidence))
-
         return TextInfo(total_score,
                         sum(total_magnitudes),
-                        categories,
+                        list(annotations.categories),
                         site,
                         content_length)
 
-    def decode_page(self, page_contents):
-        try:
-            return page_contents.decode(encoding="utf-8")
-        except:
+    def get_page_encoding(self, header_charset, first_chunk):
+        sniffed_charset = None
+        match = META_CHARSET_PATTERN.search(first_chunk[:CHARSET_SNIFF_SIZE])
+        if match is not None:
+            sniffed_charset = match.group(1).decode("ascii")
+
+        for charset in (header_charset, sniffed_charset):
+            if not charset:
+                continue
+
             try:
-                return page_contents.decode(encoding="latin-1")
-            except:
-                return page_contents.decode(encoding="utf-8", errors="replace")
+                return codecs.lookup(charset).name
+            except LookupError:
+                # pages sometimes declare made up charsets
+                continue
 
-    def get_sentiment_score(self, target_entity):
-        # TODO
-        # check if this has been queried recently (e.g. within the last 30 days)
-        # and return the sentiment from the db, if so, so that we don't need
-        # to query the google API
+        return None
+
+    # reads and decodes the page a chunk at a time, giving up as soon as it
+    # goes over MAX_PAGE_DOWNLOAD_SIZE, the deadline passes, or the query no
+    # longer needs it. returns (page contents, None) or (None, skip reason)
+    def read_page(self, response, deadline=None, cancelled=None, trace=None):
+        header_charset = get_header_charset(
+            response.headers.get("content-type"))
+        raw_size = 0
+        decode_seconds = 0.0
+        decoder = None
+        # only kept around while we're guessing that the page is utf-8, in
+        # case it turns out not to be
+        raw_chunks = None
+        text_chunks = []
+
+        for chunk in response.stream(PAGE_CHUNK_SIZE):
+            if decoder is None:
+                encoding = self.get_page_encoding(header_charset, chunk)
+                if encoding is None:
+                    decoder = codecs.getincrementaldecoder("utf-8")()
+                    raw_chunks = []
+                else:
+                    decoder = codecs.getincrementaldecoder(encoding)(
+                        errors="replace")
+
+            raw_size += len(chunk)
+            if raw_size > MAX_PAGE_DOWNLOAD_SIZE:
+                return None, SKIP_TOO_LARGE
+
+            if deadline is not None and time.monotonic() > deadline:
+                return None, SKIP_TIMEOUT
+
+            if cancelled is not None and cancelled.is_set():
+                return None, SKIP_CANCELLED
+
+            if raw_chunks is not None:
+                raw_chunks.append(chunk)
+
+            decode_start = time.perf_counter()
+            try:
+                text_chunks.append(decoder.decode(chunk))
+            except UnicodeDecodeError:
+                # nothing told us what the page was in and it isn't utf-8,
+                # so fall back to latin-1, which decodes anything
+                decoder = codecs.getincrementaldecoder("latin-1")()
+                text_chunks = [decoder.decode(b"".join(raw_chunks))]
+                raw_chunks = None
+            decode_seconds += time.perf_counter() - decode_start
+
+        if decoder is None:
+            return "", None
 
-        GOOGLE_SEARCH_PAGE = "https://google.com/search?q={}"
+        try:
+            text_chunks.append(decoder.decode(b"", final=True))
+        except UnicodeDecodeError:
+            # cut off in the middle of a character
+            pass
 
+        self.metrics.observe_stage("decode", decode_seconds, raw_size, trace)
+        return "".join(text_chunks), None
+
+    def get_search_links(self, target_entity, trace=None):
         # urllib uses python urllib/3.3.0 as the user agent on the request
         # by default, so we need to go through with using Mozilla or Chrome
         # or something well known to indicate that this isn't a bot with
@@ -338,73 +797,816 @@ class SintMint():
         # TODO: empirically, it seems like better results come up when
         # prefixing searches to include "opinion" in them
         google_search = "opinion of {}".format(target_entity)
-        url = GOOGLE_SEARCH_PAGE.format(urllib.parse.quote(google_search))
-        request = urllib.request.Request(
-            url,
-            headers={'User-Agent': 'Mozilla/5.0'})
-        page_contents = urllib.request.urlopen(request)
+        url = self.search_page.format(urllib.parse.quote(google_search))
 
-        self.parser.feed(page_contents.read().decode())
+        cached = None
+        if self.page_cache is not None:
+            cached = self.page_cache.get_entry(url, SEARCH_ENTRY)
+            self.metrics.record_cache("search", cached is not None, trace)
+
+        if cached is not None:
+            page_contents = cached["contents"]
+        else:
+            page_contents = self.download_search_page(url, trace)
 
-        # follow the links on the main page, and then those will collectively
-        # construct our info on the initial input text
-        # limit to some finite number (e.g. 3) links so that we don't have to
-        # request too many times
         seen_links = set()
-        unique_links = [link for link in self.parser.links if not \
-                        (link in seen_links or seen_links.add(link))]
-        text_infos = []
-        links_fetched = 0
-        NUM_LINKS_TO_CHECK = 3
-        for link in unique_links:
-            print(link)
-            request = urllib.request.Request(
-                link,
-                headers={"User-Agent": DEFAULT_USER_AGENT,
-                         "Accept": DEFAULT_ACCEPT})
+        unique_links = [link for link in get_result_links(page_contents) if \
+                        not (link in seen_links or seen_links.add(link))]
+
+        return unique_links
+
+    # raises urllib3's TimeoutError if the search can't be done within the
+    # query timeout, e.g. while google has us backing off
+    def download_search_page(self, url, trace=None):
+        deadline = time.monotonic() + self.query_timeout
+        with self.metrics.time_stage("search", trace) as stage:
+            response, page_contents = self.fetcher.get(
+                url,
+                headers={'User-Agent': 'Mozilla/5.0'},
+                bucket=self.search_bucket,
+                deadline=deadline)
+            stage.num_bytes = len(page_contents)
+
+        # there's nothing we can do without the search results (e.g. if
+        # google is rate limiting us)
+        if response.status >= 400:
+            raise HTTPError(url,
+                            response.status,
+                            response.reason,
+                            response.headers,
+                            None)
+
+        page_contents = page_contents.decode()
+        if self.page_cache is not None:
+            self.page_cache.put_search(url, page_contents)
+
+        return page_contents
+
+    # returns the cleaned contents of the page, or None if the page is not
+    # something we can send off to google
+    def fetch_page(self, link, cancelled=None, trace=None):
+        logger.debug("Fetching %s", link)
+
+        cached = None
+        if self.page_cache is not None:
+            cached = self.page_cache.get_entry(link, self.document_type)
+            fresh = cached is not None and self.page_cache.is_fresh(cached)
+            self.metrics.record_cache("page", fresh, trace)
+            if fresh:
+                return self.use_cached_page(link, cached, trace)
+
+        page_contents, skip_reason, status, validators = self.download_page(
+            link,
+            cancelled,
+            trace,
+            cached)
+        if skip_reason == PAGE_NOT_MODIFIED:
+            self.page_cache.refresh(cached, self.document_type)
+            return cached["contents"]
+
+        if page_contents is None:
+            self.skip_page(link, skip_reason, status, trace)
+            return None
+
+        page_contents = self.clean_page(link, page_contents, trace)
+        if page_contents is None or \
+           len(page_contents) < MIN_GOOGLE_REQUEST_SIZE:
+            self.skip_page(link, SKIP_TOO_SMALL, trace=trace)
+            return None
+
+        if self.page_cache is not None:
+            self.page_cache.put_page(link,
+                                     self.document_type,
+                                     page_contents,
+                                     **validators)
+
+        return page_contents
+
+    # returns the cleaned contents of the page (see clean.clean_page). the
+    # clean and extract stages are timed in the cleaning process, and
+    # clean_queue is however long the page waited to get there
+    def clean_page(self, link, page_contents, trace=None):
+        as_text = self.document_type == DOCUMENT_TYPE_TEXT
+        start = time.perf_counter()
+
+        if self.clean_workers == 0:
+            page_contents, stage_seconds = clean.clean_page(page_contents,
+                                                            as_text)
+        else:
+            with self.clean_slots:
+                clean_pool = self.get_clean_pool()
+                try:
+                    page_contents, stage_seconds = clean_pool.submit(
+                        clean.clean_page,
+                        page_contents,
+                        as_text).result()
+                except BrokenProcessPool:
+                    # e.g. a worker ran out of memory on a huge page. the
+                    # next page gets a new pool, and this one gets cleaned
+                    # here instead
+                    logger.warning("Cleaning processes died on %s", link)
+                    self.reset_clean_pool(clean_pool)
+                    page_contents, stage_seconds = clean.clean_page(
+                        page_contents,
+                        as_text)
+
+        seconds = time.perf_counter() - start
+        self.metrics.observe_stage("clean_queue",
+                                   max(0, seconds - \
+                                       sum(stage_seconds.values())),
+                                   trace=trace,
+                                   link=link)
+        self.metrics.observe_stage("clean",
+                                   stage_seconds["clean"],
+                                   trace=trace,
+                                   link=link)
+        if "extract" in stage_seconds:
+            self.metrics.observe_stage("extract",
+                                       stage_seconds["extract"],
+                                       len(page_contents),
+                                       trace,
+                                       link=link)
+
+        return page_contents
+
+    def use_cached_page(self, link, cached, trace=None):
+        if cached["kind"] == PAGE_ENTRY:
+            return cached["contents"]
+
+        self.metrics.record_skip(cached["skip_reason"],
+                                 trace,
+                                 link=link,
+                                 cached=True)
+        return None
+
+    # status is the page's HTTP status, if it got that far
+    def skip_page(self, link, skip_reason, status=None, trace=None):
+        self.metrics.record_skip(skip_reason, trace, link=link)
+
+        if self.page_cache is None:
+            return
 
+        if skip_reason in CACHED_SKIP_REASONS or \
+           (skip_reason == SKIP_HTTP_ERROR and status is not None and \
+            400 <= status < 500 and status not in UNCACHED_CLIENT_ERRORS):
+            self.page_cache.put_skipped(link, self.document_type, skip_reason)
+
+    def get_conditional_headers(self, cached):
+        headers = {}
+        if cached is None or cached["kind"] != PAGE_ENTRY:
+            return headers
+
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    # returns (decoded page, None, status, validators) or (None, skip reason,
+    # status, validators), where status is None if the site never answered
+    # and validators are the ETag and Last-Modified to revalidate the page
+    # with later. if cached (a page cache entry) is given, the site can tell
+    # us it hasn't changed, in which case the skip reason is
+    # PAGE_NOT_MODIFIED
+    def download_page(self, link, cancelled=None, trace=None, cached=None):
+        # the deadline starts once we actually get to the page, not when it
+        # was queued up
+        deadline = time.monotonic() + self.link_timeout
+
+        headers = {"User-Agent": DEFAULT_USER_AGENT, "Accept": DEFAULT_ACCEPT}
+        headers.update(self.get_conditional_headers(cached))
+
+        with self.metrics.time_stage("fetch", trace, link=link):
+            try:
+                response = self.fetcher.open(
+                    link,
+                    headers=headers,
+                    bucket=self.host_limiter.get_bucket(
+                        urllib.parse.urlsplit(link).netloc),
+                    max_retries=RESULT_PAGE_MAX_RETRIES,
+                    max_retry_wait=RESULT_PAGE_MAX_RETRY_WAIT,
+                    deadline=deadline,
+                    cancelled=cancelled)
+            except urllib3.exceptions.HTTPError as err:
+                # timeouts, too many redirects, connection errors, etc.
+                return None, get_error_skip_reason(err, cancelled), None, {}
+
+            status = response.status
+            header = response.headers
+            validators = {"etag": header.get("etag"),
+                          "last_modified": header.get("last-modified")}
             try:
-                page_contents = urllib.request.urlopen(request)
+                if status == 304 and cached is not None:
+                    return None, PAGE_NOT_MODIFIED, status, validators
 
-                # skip over non-html pages (e.g. PDFs) for now to avoid having
-                # to deal with downloads etc. (maybe PDFs will be good at some
-                # point for scholarly articles)
-                header = page_contents.info()
-                if "text/html" not in header["content-type"]:
+                # TODO catch only 404 and https cert errors?
+                if status >= 400:
+                    return None, SKIP_HTTP_ERROR, status, validators
+
+                # skip over non-html pages (e.g. PDFs) for now to avoid
+                # having to deal with downloads etc. (maybe PDFs will be good
+                # at some point for scholarly articles)
+                if "text/html" not in header.get("content-type", ""):
+                    return None, SKIP_NON_HTML, status, validators
+
+                # no need to download pages we already know are too big or
+                # too small to use (compressed pages can only be ruled out
+                # for being too big, since they'll only get bigger once
+                # decompressed)
+                content_length = header.get("content-length", "")
+                if content_length.isdigit():
+                    if int(content_length) > MAX_PAGE_DOWNLOAD_SIZE:
+                        return None, SKIP_TOO_LARGE, status, validators
+
+                    if int(content_length) < MIN_GOOGLE_REQUEST_SIZE and \
+                       "content-encoding" not in header:
+                        return None, SKIP_TOO_SMALL, status, validators
+
+                page_contents, skip_reason = self.read_page(response,
+                                                            deadline,
+                                                            cancelled,
+                                                            trace)
+                return page_contents, skip_reason, status, validators
+            except urllib3.exceptions.HTTPError as err:
+                # e.g. the site stopped sending us the page part way through
+                return (None,
+                        get_error_skip_reason(err, cancelled),
+                        status,
+                        validators)
+            finally:
+                self.fetcher.release(response)
+
+    # every entity that uses this page gets scored against the same arrays,
+    # so they only get pulled out of the response once
+    def annotate_page(self, page_contents, trace=None):
+        return AnnotationArrays(self.get_text_annotations(page_contents,
+                                                          trace))
+
+    # the annotation cache keeps pages that were annotated as part of a pack
+    # apart from ones that were annotated on their own, since their responses
+    # were pieced back together from the pack's
+    def get_packed_cache_key(self, page_contents, features):
+        return self.annotation_cache.get_key(page_contents,
+                                             self.document_type,
+                                             dict(features, packed=True))
+
+    # annotates [(page contents, trace)] in one request, for the packer.
+    # returns the annotation arrays of each page
+    def annotate_pack(self, documents):
+        from google.cloud import language_v1
+
+        if len(documents) == 1:
+            return [self.annotate_page(*documents[0])]
+
+        features = self.get_features(
+            PACK_SEPARATOR.join(page_contents for page_contents, trace in \
+                                documents))
+
+        results = [None] * len(documents)
+        uncached = []
+        for i, (page_contents, trace) in enumerate(documents):
+            if self.annotation_cache is not None:
+                cached_response = self.annotation_cache.get(
+                    self.get_packed_cache_key(page_contents, features))
+                self.metrics.record_cache("annotation",
+                                          cached_response is not None,
+                                          trace)
+                if cached_response is not None:
+                    results[i] = AnnotationArrays(
+                        language_v1.AnnotateTextResponse.deserialize(
+                            cached_response))
                     continue
 
-            except HTTPError as err:
-                # TODO catch only 404 and https cert errors?
-                continue
+            uncached.append(i)
+
+        if len(uncached) == 0:
+            return results
 
-            page_contents = self.cleaner.clean_html(
-                self.decode_page(page_contents.read()))
+        contents = [documents[i][0] for i in uncached]
+        packed_contents = PACK_SEPARATOR.join(contents)
+        document = language_v1.Document(
+            content=packed_contents,
+            type_=language_v1.Document.Type.PLAIN_TEXT)
+
+        # offsets in code points, which is what python indexes strings by
+        start = time.perf_counter()
+        response = self.annotate_with_retries(document,
+                                              features,
+                                              language_v1.EncodingType.UTF32)
+        seconds = time.perf_counter() - start
+        self.metrics.observe_stage("annotate_packed",
+                                   seconds,
+                                   len(packed_contents.encode()))
+        self.metrics.record_language_units(self.analysis_tier,
+                                           features,
+                                           len(packed_contents))
+
+        responses = split_response(response, get_document_offsets(contents))
+        for i, document_response in zip(uncached, responses):
+            page_contents, trace = documents[i]
+            if trace is not None:
+                trace.add("annotate_packed",
+                          seconds=round(seconds, 6),
+                          num_documents=len(contents))
+
+            if self.annotation_cache is not None:
+                self.annotation_cache.put(
+                    self.get_packed_cache_key(page_contents, features),
+                    document_response.SerializeToString())
+
+            results[i] = AnnotationArrays(document_response)
+
+        return results
+
+    # returns [(category, confidence)]
+    def classify_page(self, page_contents, trace=None):
+        from google.api_core import exceptions as google_exceptions
+
+        # the start of a long page is plenty to tell what it's about
+        if len(page_contents) > SIZE_CAP:
+            page_contents = split_into_chunks(page_contents, SIZE_CAP)[0]
+
+        features = {"classify_text": True}
+        try:
+            response = self.get_text_annotations(page_contents,
+                                                 trace,
+                                                 features,
+                                                 stage="classify")
+        except google_exceptions.InvalidArgument as err:
+            # e.g. not enough words in it, which leaves it without a category
+            # but is otherwise fine
+            logger.info("Couldn't classify page: %r", err)
+            return []
+
+        return AnnotationArrays(response).categories
+
+    # pages shared between entities in a batch only show up in the trace of
+    # whichever entity got to them first
+    def submit_fetch(self, link, batch, cancelled=None, trace=None):
+        with batch.lock:
+            fetch = batch.fetches.get(link)
+            if fetch is None:
+                fetch = self.fetch_pool.submit(self.fetch_page,
+                                               link,
+                                               cancelled,
+                                               trace)
+                batch.fetches[link] = fetch
+
+        return fetch
+
+    # returns the page contents from a finished fetch_page, or None if it
+    # was skipped. a page failing in some way we didn't see coming just gets
+    # skipped, rather than taking the rest of the query down with it
+    def get_fetch_result(self, link, fetch, trace=None):
+        try:
+            return fetch.result()
+        except Exception:
+            logger.exception("Failed to fetch %s", link)
+            self.skip_page(link, SKIP_FAILED, trace=trace)
+            return None
+
+    # returns [chunk], where every chunk is small enough to send off on its
+    # own
+    def get_page_chunks(self, page_contents, trace=None):
+        if len(page_contents) <= SIZE_CAP:
+            return [page_contents]
+
+        chunks = split_into_chunks(page_contents, SIZE_CAP)
+        if len(chunks) > MAX_PAGE_CHUNKS:
+            logger.info("Only annotating %d of %d chunks",
+                        MAX_PAGE_CHUNKS,
+                        len(chunks))
+            chunks = chunks[:MAX_PAGE_CHUNKS]
+
+        # the last one can end up with only a few characters in it
+        chunks = [chunk for chunk in chunks if \
+                  len(chunk) >= MIN_GOOGLE_REQUEST_SIZE]
+
+        if trace is not None:
+            trace.add("chunked",
+                      num_chunks=len(chunks),
+                      content_length=len(page_contents))
+
+        return chunks
+
+    # annotates each chunk of the page in parallel. returns a future of
+    # [(chunk length, annotation arrays)], which leaves out any chunks that
+    # failed, unless all of them did
+    def start_chunk_annotations(self, page_contents, trace=None):
+        chunks = self.get_page_chunks(page_contents, trace)
+        chunk_annotations = []
+        for chunk in chunks:
+            if self.packer is not None and \
+               len(chunk) <= MAX_PACKED_DOCUMENT_SIZE:
+                chunk_annotations.append(self.packer.submit(chunk, trace))
+            else:
+                chunk_annotations.append(
+                    self.annotate_pool.submit(self.annotate_page,
+                                              chunk,
+                                              trace))
+
+        page_annotation = Future()
+        lock = threading.Lock()
+        num_remaining = len(chunk_annotations)
+
+        def finish_chunk(chunk_annotation):
+            nonlocal num_remaining
+            with lock:
+                num_remaining -= 1
+                if num_remaining > 0:
+                    return
+
+            results = []
+            error = None
+            for chunk, chunk_annotation in zip(chunks, chunk_annotations):
+                if chunk_annotation.exception() is not None:
+                    error = chunk_annotation.exception()
+                    continue
+                results.append((len(chunk), chunk_annotation.result()))
+
+            if len(results) == 0:
+                page_annotation.set_exception(error)
+            else:
+                page_annotation.set_result(results)
+
+        for chunk_annotation in chunk_annotations:
+            chunk_annotation.add_done_callback(finish_chunk)
+
+        return page_annotation
+
+    def submit_annotation(self, link, page_contents, batch, trace=None):
+        with batch.lock:
+            annotation = batch.annotations.get(link)
+            if annotation is None:
+                annotation = (len(page_contents),
+                              self.start_chunk_annotations(page_contents,
+                                                           trace))
+                batch.annotations[link] = annotation
+
+            # once a page is being annotated, other entities only need the
+            # annotation, so there's no reason to keep the page around
+            batch.fetches.pop(link, None)
+
+        return annotation
+
+    def get_batch_annotation(self, link, batch):
+        # pages another entity in the batch already got to don't need to be
+        # downloaded again
+        with batch.lock:
+            return batch.annotations.get(link)
+
+    # returns [(link, (content length, future of the annotation arrays),
+    #          page contents)]. the page contents are None for pages another
+    # entity in the batch already started annotating
+    # on_annotation, if given, gets called with the link and annotation of
+    # each page as soon as it's started
+    def start_ordered_annotations(self, links, num_links, batch, owns_batch,
+                                  trace=None, on_annotation=None):
+        # keep a window of downloads in flight, but consume them in the order
+        # of the search results so that we still end up with the first
+        # num_links usable pages. each usable page is handed off to be
+        # annotated right away, while the rest of the pages are downloading
+        links = iter(links)
+        fetches = deque()
+        annotations = []
+
+        def fill_fetch_window():
+            while len(fetches) < self.fetch_workers:
+                link = next(links, None)
+                if link is None:
+                    return
+
+                annotation = self.get_batch_annotation(link, batch)
+                if annotation is not None:
+                    fetches.append((link, None, annotation))
+                else:
+                    fetches.append(
+                        (link,
+                         self.submit_fetch(link, batch, trace=trace),
+                         None))
+
+        fill_fetch_window()
+        while fetches and len(annotations) < num_links:
+            link, fetch, annotation = fetches.popleft()
+            fill_fetch_window()
+
+            page_contents = None
+            if annotation is None:
+                page_contents = self.get_fetch_result(link, fetch, trace)
+                if page_contents is None:
+                    continue
+
+                annotation = self.submit_annotation(link,
+                                                    page_contents,
+                                                    batch,
+                                                    trace)
+
+            annotations.append((link, annotation, page_contents))
+            if on_annotation is not None:
+                on_annotation(link, annotation)
+
+        # we have enough pages, so don't bother with the ones that haven't
+        # started downloading yet
+        if owns_batch:
+            for link, fetch, annotation in fetches:
+                if fetch is not None:
+                    fetch.cancel()
+
+        return annotations
+
+    # same as start_ordered_annotations, but takes whichever usable pages
+    # come back first, and stops looking once the query deadline passes
+    def start_hedged_annotations(self, links, num_links, batch, owns_batch,
+                                 trace=None, on_annotation=None):
+        query_deadline = time.monotonic() + self.query_timeout
+
+        # lets the downloads we no longer need stop part way through. other
+        # entities in a shared batch might still want them though
+        cancelled = threading.Event() if owns_batch else None
+
+        links = iter(links)
+        fetches = {}
+        annotations = []
+
+        def start_fetches():
+            while len(annotations) < num_links and \
+                  len(fetches) < (num_links - len(annotations)) * \
+                                 HEDGED_FETCHES_PER_LINK:
+                link = next(links, None)
+                if link is None:
+                    return
+
+                annotation = self.get_batch_annotation(link, batch)
+                if annotation is not None:
+                    annotations.append((link, annotation, None))
+                    if on_annotation is not None:
+                        on_annotation(link, annotation)
+                else:
+                    fetch = self.submit_fetch(link, batch, cancelled, trace)
+                    fetches[fetch] = link
+
+        start_fetches()
+        while fetches and len(annotations) < num_links:
+            remaining = query_deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            done, not_done = wait(fetches,
+                                  timeout=remaining,
+                                  return_when=FIRST_COMPLETED)
+            for fetch in done:
+                link = fetches.pop(fetch)
+                page_contents = self.get_fetch_result(link, fetch, trace)
+                if page_contents is None or len(annotations) >= num_links:
+                    continue
 
-            # can't use it in this case
-            if len(page_contents) > MAX_GOOGLE_REQUEST_SIZE or \
-               len(page_contents) < MIN_GOOGLE_REQUEST_SIZE:
+                annotation = self.submit_annotation(link,
+                                                    page_contents,
+                                                    batch,
+                                                    trace)
+                annotations.append((link, annotation, page_contents))
+                if on_annotation is not None:
+                    on_annotation(link, annotation)
+
+            start_fetches()
+
+        if owns_batch:
+            cancelled.set()
+            for fetch in fetches:
+                fetch.cancel()
+
+        return annotations
+
+    # progress, if given, gets called with a dict for each page as soon as
+    # it's been scored (see report_progress)
+    def get_text_infos(self, links, target_entity,
+                       num_links=NUM_LINKS_TO_CHECK, batch=None, trace=None,
+                       progress=None):
+        target_entity = self.get_target_entity(target_entity)
+
+        # cancelling downloads is only safe if no other entity is waiting on
+        # them as well
+        owns_batch = batch is None
+        if owns_batch:
+            batch = PageBatch()
+
+        on_annotation = None
+        reports = []
+        if progress is not None:
+            on_annotation, reports = self.report_progress(target_entity,
+                                                          progress)
+
+        if self.hedged:
+            annotations = self.start_hedged_annotations(links,
+                                                        num_links,
+                                                        batch,
+                                                        owns_batch,
+                                                        trace,
+                                                        on_annotation)
+        else:
+            annotations = self.start_ordered_annotations(links,
+                                                         num_links,
+                                                         batch,
+                                                         owns_batch,
+                                                         trace,
+                                                         on_annotation)
+
+        # a single query in hedged mode doesn't wait on the annotations any
+        # longer than the annotate_text deadline. in a batch, the annotations
+        # can be queued up behind other entities' for a while, so there the
+        # gRPC deadline is the only one
+        annotate_deadline = None
+        if self.hedged and owns_batch:
+            annotate_deadline = time.monotonic() + self.annotate_timeout
+
+        classifications = {}
+        if self.analysis_tier == ANALYSIS_ADAPTIVE or \
+           (self.analysis_tier == ANALYSIS_FULL and self.packer is not None):
+            classifications = self.start_classifications(annotations,
+                                                         batch,
+                                                         trace)
+
+        # we can alternatively bundle up all of the text into one pile and
+        # sent that in one request, but it might be better to get sentiment
+        # analysis from different texts separately, and weight the documents
+        # that have higher saliency for the target more
+        text_infos = []
+        annotate_error = None
+        for link, (content_length, annotation), page_contents in annotations:
+            timeout = None
+            if annotate_deadline is not None:
+                timeout = max(0, annotate_deadline - time.monotonic())
+
+            # the rest of the pages are still worth using if one of them
+            # fails or times out
+            try:
+                chunk_annotations = annotation.result(timeout=timeout)
+            except Exception as err:
+                logger.warning("Failed to annotate %s: %r", link, err)
+                if trace is not None:
+                    trace.add("annotate_failed", link=link, error=repr(err))
+                annotate_error = err
                 continue
 
-            # we can alternatively bundle up all of the text into one pile and
-            # sent that in one request, but it might be better to get sentiment
-            # analysis from different texts separately, and weight the documents
-            # that have higher saliency for the target more
-            text_annotations = self.get_text_annotations(page_contents)
-            text_info = self.analyze_text_annotations(text_annotations,
-                                                      target_entity,
-                                                      link,
-                                                      len(page_contents))
+            text_info = self.get_page_text_info(link,
+                                                content_length,
+                                                chunk_annotations,
+                                                target_entity,
+                                                trace)
+
+            classification = classifications.get(link)
+            if classification is not None:
+                timeout = None
+                if annotate_deadline is not None:
+                    timeout = max(0, annotate_deadline - time.monotonic())
+
+                # the page's sentiment is still good without a category
+                try:
+                    text_info.categories = classification.result(
+                        timeout=timeout)
+                except Exception as err:
+                    logger.warning("Failed to classify %s: %r", link, err)
+
             text_infos.append(text_info)
 
-            links_fetched += 1
-            if links_fetched == NUM_LINKS_TO_CHECK:
+        # the pages we got to all get reported before the query's result is
+        # in. they're reported from the annotations' callbacks, which can
+        # still be running after we're done waiting on the annotations
+        wait([report for report, (link, (content_length, annotation),
+                                  page_contents) in \
+              zip(reports, annotations) if annotation.done()])
+
+        if len(text_infos) == 0 and annotate_error is not None:
+            raise annotate_error
+
+        return text_infos
+
+    # chunk_annotations are [(chunk length, annotation arrays)] for the page
+    def get_page_text_info(self, link, content_length, chunk_annotations,
+                           target_entity, trace=None):
+        if len(chunk_annotations) == 1:
+            return self.analyze_text_annotations(chunk_annotations[0][1],
+                                                 target_entity,
+                                                 link,
+                                                 content_length,
+                                                 trace)
+
+        return self.merge_text_infos(
+            [self.analyze_text_annotations(annotation_arrays,
+                                           target_entity,
+                                           link,
+                                           chunk_length,
+                                           trace) for \
+             chunk_length, annotation_arrays in chunk_annotations],
+            link,
+            content_length)
+
+    # returns an on_annotation for start_*_annotations that, once each page
+    # has been annotated, calls progress with the page's score and what the
+    # query's score and category come to with the pages so far. that happens
+    # as each annotation finishes, rather than once all of them have, so the
+    # first one only has to wait on a single page. categories the adaptive
+    # tier gets separately aren't in there yet
+    # also returns a future for each page (in the order on_annotation was
+    # called) that's done once the page has been reported
+    def report_progress(self, target_entity, progress):
+        text_infos = []
+        reports = []
+        lock = threading.Lock()
+
+        def report_page(link, content_length, page_annotation):
+            if page_annotation.exception() is not None:
+                return
+
+            text_info = self.get_page_text_info(link,
+                                                content_length,
+                                                page_annotation.result(),
+                                                target_entity)
+            # held while calling progress, so that the updates go out in the
+            # order the totals were worked out in
+            with lock:
+                text_infos.append(text_info)
+                total_score, likely_category = self.combine_text_infos(
+                    text_infos,
+                    target_entity.name)
+                # combine_text_infos weighs pages against each other's
+                # lengths, which leaves a page on its own with no weight at
+                # all, so the first page's total is just its own score
+                if len(text_infos) == 1:
+                    total_score = text_info.score
+                progress({"site": link,
+                          "score": text_info.score,
+                          "magnitude": text_info.magnitude,
+                          "total_score": total_score,
+                          "category": likely_category,
+                          "num_pages": len(text_infos)})
+
+        def on_annotation(link, annotation):
+            content_length, page_annotation = annotation
+            reported = Future()
+            reports.append(reported)
+
+            def report(page_annotation):
+                try:
+                    report_page(link, content_length, page_annotation)
+                finally:
+                    reported.set_result(None)
+
+            page_annotation.add_done_callback(report)
+
+        return on_annotation, reports
+
+    # classifies the longest of the query's pages, since those have the most
+    # for google to go off of. returns {link: future of its categories}
+    def start_classifications(self, annotations, batch, trace=None):
+        classifications = {}
+        longest_first = sorted(annotations,
+                               key=lambda annotation: annotation[1][0],
+                               reverse=True)
+        for link, (content_length, annotation), page_contents in \
+            longest_first:
+            if len(classifications) >= ADAPTIVE_CLASSIFIED_PAGES:
                 break
 
-            # so that we don't HTTP Error 429 for too many requests
-            # TODO: can catch that error and try again later
-            GOOGLE_REQUEST_TIMEOUT = 1
-            time.sleep(GOOGLE_REQUEST_TIMEOUT)
+            with batch.lock:
+                classification = batch.classifications.get(link)
+                if classification is None and page_contents is not None:
+                    classification = self.annotate_pool.submit(
+                        self.classify_page,
+                        page_contents,
+                        trace)
+                    batch.classifications[link] = classification
+
+            if classification is not None:
+                classifications[link] = classification
+
+        return classifications
+
+    # combines the text infos of a page's chunks into one for the whole page,
+    # the same way google combines sentences into a document: the score is
+    # weighted by magnitude and the magnitudes add up. categories are
+    # weighted by how much of the page each chunk is
+    def merge_text_infos(self, text_infos, site, content_length):
+        scores = [text_info.score for text_info in text_infos]
+        magnitudes = [text_info.magnitude for text_info in text_infos]
+
+        total_length = sum(text_info.content_length for text_info in \
+                           text_infos)
+        categories = defaultdict(float)
+        for text_info in text_infos:
+            for category, confidence in text_info.categories:
+                categories[category] += \
+                    confidence * text_info.content_length / total_length
+
+        return TextInfo(get_weighted_average(scores, magnitudes),
+                        sum(magnitudes),
+                        sorted(categories.items(),
+                               key=lambda category: category[1],
+                               reverse=True),
+                        site,
+                        content_length)
 
+    def combine_text_infos(self, text_infos, target_entity):
         # across the text infos, add up the scores, computing a weight or
         # salience as the magnitude relative to the total magnitude we saw
         # across all of the texts
@@ -413,7 +1615,7 @@ class SintMint():
         text_lengths = []
         content_categories = defaultdict(list)
         for text_info in text_infos:
-            print(text_info)
+            logger.debug("%s", text_info)
 
             # TODO should we factor in texts that have scores close to 0?
             # that will probably reflect in the magnitude anyway?
@@ -429,14 +1631,15 @@ class SintMint():
         # lengths (since magnitude inevitably gets larger for longer articles)
         # TODO check if this calculation needs any tweaks to make it better
         text_length_weights = self.normalize_magnitudes(text_lengths)
-        text_magnitudes = [a * (1 - b) for a, b in \
-                           zip(text_magnitudes, text_length_weights)]
+        text_magnitudes = np.asarray(text_magnitudes, dtype=float) * \
+            (1 - np.asarray(text_length_weights, dtype=float))
 
         text_weights = self.normalize_magnitudes(text_magnitudes)
         total_score = get_weighted_average(text_scores, text_magnitudes)
 
-        print("Overall raw sentiment score for {}: {}".format(target_entity,
-                                                              total_score))
+        logger.info("Overall raw sentiment score for %s: %s",
+                    target_entity,
+                    total_score)
 
         likely_category = None
         max_confidence = -1
@@ -446,7 +1649,139 @@ class SintMint():
                 likely_category = category
                 max_confidence = confidence
 
-        print("Most likely category: {}".format(likely_category))
+        logger.info("Most likely category: %s", likely_category)
 
-        self.parser.links.clear()
         return total_score, likely_category
+
+    # pass in a metrics.Trace to get a record of where this query's time went,
+    # and a progress function to hear about each page as it's scored (see
+    # get_text_infos)
+    # refresh skips over the store (and doesn't count as somebody asking for
+    # the entity), for re-scoring entities before their results go stale
+    def get_sentiment_score(self, target_entity, batch=None, trace=None,
+                            progress=None, refresh=False):
+        # if this has been queried recently (e.g. within the last 30 days),
+        # return the sentiment from the store, so that we don't need to query
+        # the google API
+        if self.store is not None and not refresh:
+            self.store.record_query(target_entity)
+            stored = self.store.get(target_entity)
+            self.metrics.record_cache("store", stored is not None, trace)
+            if stored is not None:
+                logger.info("Using stored sentiment for %s", stored.entity)
+                return stored.total_score, stored.likely_category
+
+        # anybody asking for an entity that's already being scored waits on
+        # that instead of scoring it all over again. they don't get the
+        # pages' progress though, only the result
+        entity = normalize_entity(target_entity)
+        with self.in_flight_lock:
+            in_flight = self.in_flight.get(entity)
+            if in_flight is None:
+                self.in_flight[entity] = Future()
+        self.metrics.record_cache("in_flight", in_flight is not None, trace)
+        if in_flight is not None:
+            return in_flight.result()
+
+        try:
+            result = self.score_entity(target_entity, batch, trace, progress)
+        except Exception as err:
+            self.finish_in_flight(entity).set_exception(err)
+            raise
+
+        self.finish_in_flight(entity).set_result(result)
+        return result
+
+    def finish_in_flight(self, entity):
+        with self.in_flight_lock:
+            return self.in_flight.pop(entity)
+
+    def score_entity(self, target_entity, batch=None, trace=None,
+                     progress=None):
+        # follow the links on the main page, and then those will collectively
+        # construct our info on the initial input text
+        # limit to some finite number (e.g. 3) links so that we don't have to
+        # request too many times
+        start = time.perf_counter()
+        links = self.get_search_links(target_entity, trace)
+        if batch is not None:
+            batch.hold(links)
+        try:
+            text_infos = self.get_text_infos(links,
+                                             target_entity,
+                                             batch=batch,
+                                             trace=trace,
+                                             progress=progress)
+        finally:
+            if batch is not None:
+                batch.release(links)
+        self.metrics.observe_query(self.analysis_tier,
+                                   time.perf_counter() - start,
+                                   trace)
+
+        # no usable pages probably means something went wrong on our end
+        # (or with the sites for a bit), and a score of 0 would look like a
+        # real answer
+        if len(text_infos) == 0:
+            raise NoUsablePagesError(
+                "No usable pages for {}".format(target_entity))
+
+        total_score, likely_category = \
+            self.combine_text_infos(text_infos, target_entity)
+        if self.store is not None:
+            self.store.put(target_entity,
+                           total_score,
+                           likely_category,
+                           text_infos)
+
+        return total_score, likely_category
+
+    # scores many entities at once, sharing the fetch and annotate pools and
+    # any pages that show up for more than one of them. yields
+    # (target_entity, total_score, likely_category) as each entity finishes,
+    # which might not be the order they were given in
+    # if traces is a dict, each entity's metrics.Trace gets put in it
+    def get_sentiment_scores(self, target_entities,
+                             batch_workers=DEFAULT_BATCH_WORKERS,
+                             traces=None):
+        batch = PageBatch()
+        target_entities = iter(target_entities)
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=batch_workers) as entity_pool:
+            def fill_entity_window():
+                while len(pending) < batch_workers:
+                    target_entity = next(target_entities, None)
+                    if target_entity is None:
+                        return
+
+                    trace = None
+                    if traces is not None:
+                        trace = traces[target_entity] = Trace()
+
+                    score = entity_pool.submit(self.get_sentiment_score,
+                                               target_entity,
+                                               batch,
+                                               trace)
+                    pending[score] = target_entity
+
+            fill_entity_window()
+            while pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for score in done:
+                    target_entity = pending.pop(score)
+
+                    # one bad entity shouldn't take down the whole batch.
+                    # it just doesn't get a result, so a resumed run will
+                    # pick it up again
+                    try:
+                        total_score, likely_category = score.result()
+                    except Exception as err:
+                        logger.warning("Failed to score %s: %r",
+                                       target_entity,
+                                       err)
+                        continue
+
+                    yield target_entity, total_score, likely_category
+
+                fill_entity_window()
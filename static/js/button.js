@@ -1,6 +1,83 @@
+// how often we check whether the query has finished
+var POLL_INTERVAL_MS = 1000;
+
+function showError(message) {
+    $("#loading_card").hide();
+    $("#live_card").hide();
+    $("#error_message").text(message);
+    $("#error_card").fadeIn();
+    $("#search_card").fadeIn();
+}
+
+function pollJob(job) {
+    $.getJSON(job.status_url)
+        .done(function(status) {
+            if (status.status === "done") {
+                window.location = job.result_url;
+            } else if (status.status === "failed") {
+                showError("Something went wrong, please try again later.");
+            } else {
+                setTimeout(function() { pollJob(job); }, POLL_INTERVAL_MS);
+            }
+        })
+        .fail(function() {
+            showError("Lost track of your search, please try again.");
+        });
+}
+
+// shows each page's score as it comes in, and goes to the result once the
+// query is done
+function streamJob(job) {
+    var events = new EventSource(job.events_url);
+
+    events.addEventListener("page", function(event) {
+        showPageUpdate(JSON.parse(event.data));
+    });
+
+    events.addEventListener("done", function(event) {
+        events.close();
+        if (JSON.parse(event.data).status === "done") {
+            window.location = job.result_url;
+        } else {
+            showError("Something went wrong, please try again later.");
+        }
+    });
+
+    // e.g. a proxy that won't pass the stream through, in which case the
+    // status is still there to poll
+    events.onerror = function() {
+        events.close();
+        pollJob(job);
+    };
+}
+
 $(document).ready(function() {
-    $("#submit_button").click(function() {
+    $("form.search").submit(function(event) {
+        // the query runs in the background, so we submit it ourselves and
+        // wait for it to finish instead of waiting on the form post
+        event.preventDefault();
+
+        $("#error_card").hide();
         $("#search_card").hide();
         $("#loading_card").fadeIn();
+        resetPageUpdates($(this).find("input[name=entity]").val());
+
+        $.post($(this).attr("action"), $(this).serialize())
+            .done(function(job) {
+                if (window.EventSource && job.events_url) {
+                    streamJob(job);
+                } else {
+                    pollJob(job);
+                }
+            })
+            .fail(function(xhr) {
+                if (xhr.status === 429) {
+                    showError("You've hit the search limit, please try " +
+                              "again later.");
+                } else {
+                    showError("Something went wrong, please try again " +
+                              "later.");
+                }
+            });
     });
 });
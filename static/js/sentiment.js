@@ -1,3 +1,49 @@
+// same range as render_sentiment in app.py, since pages hardly ever get
+// anywhere near the [-1.0, 1.0] bounds
+var RANGE_RADIUS = 0.3;
+
+function clampScore(score) {
+    return Math.max(-RANGE_RADIUS, Math.min(RANGE_RADIUS, score));
+}
+
+function getSentimentPercent(score) {
+    return (clampScore(score) + RANGE_RADIUS) / (RANGE_RADIUS * 2) * 100;
+}
+
+function getDisplayedPercent(score) {
+    return Math.round(Math.abs(clampScore(score)) / RANGE_RADIUS * 10000) /
+        100;
+}
+
+function resetPageUpdates(targetEntity) {
+    $("#live_entity").text(targetEntity);
+    $("#live_summary").text("");
+    $("#live_category").hide();
+    $("#live_sites").empty();
+    $("#sentiment_bar").css("width", "50%");
+}
+
+// called with each page's update while the query is running, see
+// SintMint.report_progress
+function showPageUpdate(update) {
+    $("#loading_card").hide();
+    $("#live_card").show();
+
+    $("#sentiment_bar").css("width",
+                            getSentimentPercent(update.total_score) + "%");
+    $("#live_summary").text(
+        getDisplayedPercent(update.total_score) + "% " +
+        (update.total_score >= 0 ? "positive" : "negative") + " from " +
+        update.num_pages + (update.num_pages === 1 ? " page" : " pages"));
+
+    if (update.category) {
+        $("#live_category").text("Category: " + update.category).show();
+    }
+
+    $("<li>").text(update.site + " (" + update.score.toFixed(2) + ")")
+        .appendTo("#live_sites");
+}
+
 $(document).ready(function() {
     // TODO make the color of the bar reflective of how far along it is
 
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+import sqlite3
+import json
+import os
+import time
+from contextlib import contextmanager
+from helpers import *
+from sintmint import TextInfo
+
+DEFAULT_STORE_PATH = os.environ.get("SINTMINT_STORE_PATH", "sintmint.db")
+
+# results don't change that quickly for most entities, so we can serve
+# stored results for a while before going back out to google
+DEFAULT_STORE_TTL = 30 * 24 * 60 * 60
+
+# once we have more entities than this stored, the least recently used ones
+# get dropped
+DEFAULT_STORE_MAX_ENTRIES = 10000
+
+# how popular an entity is goes by how many times it's been queried, with
+# each query counting for half as much after this long
+DEFAULT_QUERY_HALF_LIFE = 24 * 60 * 60
+
+class StoredSentiment():
+    def __init__(self, entity, total_score, likely_category, text_infos,
+                 created):
+        self.entity = entity
+        self.total_score = total_score
+        self.likely_category = likely_category
+        self.text_infos = text_infos
+        self.created = created
+
+class SentimentStore():
+
+    def __init__(self,
+                 path=DEFAULT_STORE_PATH,
+                 ttl=DEFAULT_STORE_TTL,
+                 max_entries=DEFAULT_STORE_MAX_ENTRIES,
+                 query_half_life=DEFAULT_QUERY_HALF_LIFE):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.query_half_life = query_half_life
+
+        with self.connect() as connection:
+            # lets queries keep reading while another thread (or process) is
+            # writing a result. this sticks with the database file
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entities ("
+                "entity TEXT PRIMARY KEY, "
+                "total_score REAL, "
+                "likely_category TEXT, "
+                "created REAL, "
+                "last_accessed REAL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS text_infos ("
+                "entity TEXT, "
+                "site TEXT, "
+                "score REAL, "
+                "magnitude REAL, "
+                "categories TEXT, "
+                "content_length INTEGER)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS text_infos_entity "
+                "ON text_infos (entity)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entities_last_accessed "
+                "ON entities (last_accessed)")
+            # target_entity is how it was last asked for, since scoring goes
+            # off of the capitalization
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "entity TEXT PRIMARY KEY, "
+                "target_entity TEXT, "
+                "popularity REAL, "
+                "last_queried REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS queries_last_queried "
+                "ON queries (last_queried)")
+
+    # a connection per operation keeps this usable from any thread (and from
+    # forked worker processes), and sqlite handles the locking between them
+    @contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, target_entity):
+        entity = normalize_entity(target_entity)
+        now = time.time()
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT total_score, likely_category, created FROM entities "
+                "WHERE entity = ?", (entity,)).fetchone()
+            if row is None:
+                return None
+
+            total_score, likely_category, created = row
+            if now - created > self.ttl:
+                return None
+
+            connection.execute(
+                "UPDATE entities SET last_accessed = ? WHERE entity = ?",
+                (now, entity))
+
+            text_infos = []
+            for site, score, magnitude, categories, content_length in \
+                connection.execute(
+                    "SELECT site, score, magnitude, categories, "
+                    "content_length FROM text_infos WHERE entity = ? "
+                    "ORDER BY rowid", (entity,)):
+                categories = [tuple(category) for category in \
+                              json.loads(categories)]
+                text_infos.append(TextInfo(score,
+                                           magnitude,
+                                           categories,
+                                           site,
+                                           content_length))
+
+        return StoredSentiment(entity,
+                               total_score,
+                               likely_category,
+                               text_infos,
+                               created)
+
+    def put(self, target_entity, total_score, likely_category, text_infos):
+        entity = normalize_entity(target_entity)
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                "DELETE FROM text_infos WHERE entity = ?", (entity,))
+            connection.execute(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?)",
+                (entity, total_score, likely_category, now, now))
+            connection.executemany(
+                "INSERT INTO text_infos VALUES (?, ?, ?, ?, ?, ?)",
+                [(entity,
+                  text_info.site,
+                  text_info.score,
+                  text_info.magnitude,
+                  json.dumps(text_info.categories),
+                  text_info.content_length) for text_info in text_infos])
+
+            self.evict(connection)
+
+    def get_popularity(self, popularity, last_queried, now):
+        half_lives = (now - last_queried) / self.query_half_life
+        return popularity * 0.5 ** half_lives
+
+    def record_query(self, target_entity):
+        entity = normalize_entity(target_entity)
+        now = time.time()
+        with self.connect() as connection:
+            # takes the write lock up front, so that somebody asking for the
+            # same entity at the same time can't overwrite our update
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT popularity, last_queried FROM queries "
+                "WHERE entity = ?", (entity,)).fetchone()
+
+            popularity = 1.0
+            if row is not None:
+                popularity += self.get_popularity(*row, now)
+
+            connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)",
+                (entity, target_entity, popularity, now))
+
+            # the entities nobody has asked about in the longest are the
+            # least popular ones anyway
+            count, = connection.execute(
+                "SELECT COUNT(*) FROM queries").fetchone()
+            if count > self.max_entries:
+                connection.execute(
+                    "DELETE FROM queries WHERE entity IN ("
+                    "SELECT entity FROM queries "
+                    "ORDER BY last_queried ASC LIMIT ?)",
+                    (count - self.max_entries,))
+
+    # returns up to limit [target entity], most popular first, of the
+    # entities with at least min_popularity whose stored results expire
+    # within refresh_ahead seconds (or already have)
+    def get_stale_popular_entities(self, limit, refresh_ahead,
+                                   min_popularity):
+        now = time.time()
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT queries.target_entity, queries.popularity, "
+                "queries.last_queried FROM queries JOIN entities "
+                "ON queries.entity = entities.entity "
+                "WHERE entities.created < ?",
+                (now - self.ttl + refresh_ahead,)).fetchall()
+
+        popular = []
+        for target_entity, popularity, last_queried in rows:
+            popularity = self.get_popularity(popularity, last_queried, now)
+            if popularity >= min_popularity:
+                popular.append((popularity, target_entity))
+
+        popular.sort(reverse=True)
+        return [target_entity for popularity, target_entity in \
+                popular[:limit]]
+
+    def evict(self, connection):
+        count, = connection.execute("SELECT COUNT(*) FROM entities").fetchone()
+        if count <= self.max_entries:
+            return
+
+        # expired entries are useless anyway, so drop those along with the
+        # least recently used ones
+        connection.execute(
+            "DELETE FROM entities WHERE entity IN ("
+            "SELECT entity FROM entities "
+            "ORDER BY created < ? DESC, last_accessed ASC LIMIT ?)",
+            (time.time() - self.ttl, count - self.max_entries))
+        connection.execute(
+            "DELETE FROM text_infos WHERE entity NOT IN "
+            "(SELECT entity FROM entities)")
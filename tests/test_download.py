@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from sintmint import *
+import threading
+import time
+
+import pytest
+
+# answers every request, just too slowly for the fetcher to wait on
+class SlowHandler(BaseHTTPRequestHandler):
+    delay = 1.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def slow_link():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/page".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+def make_sintmint():
+    return SintMint(fetcher=PageFetcher(read_timeout=0.2), clean_workers=0)
+
+def test_read_timeout_is_skipped_as_timeout(slow_link):
+    page_contents, skip_reason, status, validators = \
+        make_sintmint().download_page(slow_link)
+
+    assert page_contents is None
+    assert skip_reason == SKIP_TIMEOUT
+    assert status is None
+
+def test_read_timeout_after_cancelling_is_skipped_as_cancelled(slow_link):
+    cancelled = threading.Event()
+    timer = threading.Timer(0.05, cancelled.set)
+    timer.start()
+    try:
+        page_contents, skip_reason, status, validators = \
+            make_sintmint().download_page(slow_link, cancelled)
+    finally:
+        timer.cancel()
+
+    assert page_contents is None
+    assert skip_reason == SKIP_CANCELLED
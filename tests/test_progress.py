@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# Author: Antony Toron
+
+from concurrent.futures import Future
+from sintmint import *
+
+def test_first_progress_update_has_the_page_score():
+    sintmint = SintMint(clean_workers=0)
+    text_infos = {"a": TextInfo(0.4, 2.0, [], "a", 5000),
+                  "b": TextInfo(-0.2, 1.0, [], "b", 3000)}
+    sintmint.get_page_text_info = lambda link, content_length, \
+        chunk_annotations, target_entity: text_infos[link]
+
+    updates = []
+    on_annotation, reports = sintmint.report_progress(
+        sintmint.get_target_entity("entity"),
+        updates.append)
+
+    for link in ["a", "b"]:
+        page_annotation = Future()
+        on_annotation(link, (text_infos[link].content_length,
+                             page_annotation))
+        page_annotation.set_result([])
+
+    assert [update["num_pages"] for update in updates] == [1, 2]
+    assert updates[0]["score"] == 0.4
+    assert updates[0]["total_score"] == 0.4
+    assert updates[1]["total_score"] != 0